@@ -15,6 +15,7 @@ import pandas as pd
 import pyautogui
 import keyboard
 import threading
+import pdf_engine
 
 # Настройка страницы
 st.set_page_config(
@@ -238,12 +239,9 @@ class PDFProcessor:
         """Обработка PDF и извлечение номеров"""
         start_time = time.time()
         
-        temp_pdf_path = os.path.join(self.temp_dir, "input.pdf")
-        with open(temp_pdf_path, 'wb') as f:
-            f.write(pdf_file.getvalue())
-        
         try:
-            doc = fitz.open(temp_pdf_path)
+            # PDF прямо из буфера загрузки, без копии и временного файла
+            doc = fitz.open(stream=pdf_file.getbuffer(), filetype="pdf")
             total_pages = len(doc)
             
             results = {
@@ -255,6 +253,22 @@ class PDFProcessor:
             
             os.makedirs(results['output_dir'], exist_ok=True)
             
+            def show_progress(progress):
+                # Счетчики копятся в reporter, в браузер - не чаще 5 раз в секунду
+                progress_bar.progress(progress['processed'] / total_pages)
+                found_count = progress['counts'].get('has_number', 0)
+                eta = progress['eta']
+                
+                status_text.text(
+                    f"📊 Обработано: {progress['processed']}/{total_pages} | "
+                    f"⚡ Скорость: {progress['recent_speed']:.1f} стр/сек | "
+                    f"⏳ Осталось: {f'~{eta:.0f}с' if eta is not None else '—'} | "
+                    f"✅ С номерами: {found_count} | "
+                    f"❌ Без номеров: {progress['processed'] - found_count}"
+                )
+            
+            reporter = pdf_engine.ProgressReporter(show_progress, total_pages)
+            
             for page_num in range(total_pages):
                 page = doc[page_num]
                 
@@ -297,22 +311,9 @@ class PDFProcessor:
                 }
                 
                 results['files'].append(file_info)
-                
-                progress = (page_num + 1) / total_pages
-                progress_bar.progress(progress)
-                
-                elapsed = time.time() - start_time
-                speed = (page_num + 1) / elapsed if elapsed > 0 else 0
-                
-                found_count = len([f for f in results['files'] if f['order_number']])
-                
-                status_text.text(
-                    f"📊 Обработано: {page_num + 1}/{total_pages} | "
-                    f"⚡ Скорость: {speed:.1f} стр/сек | "
-                    f"✅ С номерами: {found_count} | "
-                    f"❌ Без номеров: {page_num + 1 - found_count}"
-                )
+                reporter.page(file_info['status'])
             
+            reporter.close()
             doc.close()
             results['processing_time'] = time.time() - start_time
             
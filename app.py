@@ -1,16 +1,12 @@
 import streamlit as st
-import fitz
 import pytesseract
-from PIL import Image
-import io
-import re
-import tempfile
 import os
-import zipfile
-import base64
 import time
 import subprocess
 import sys
+import pdf_engine
+import download_server
+import jobs
 
 # Настройка страницы
 st.set_page_config(
@@ -67,18 +63,14 @@ if 'tesseract_checked' not in st.session_state:
     st.session_state.tesseract_checked = True
 
 tesseract_available = st.session_state.tesseract_available
-# Глобальная переменная для остановки
-class StopProcessing:
-    def __init__(self):
-        self._stop = False
-    
-    def set(self):
-        self._stop = True
-    
-    def is_set(self):
-        return self._stop
 
-stop_processing = StopProcessing()
+# Опрос состояния фонового задания, секунд
+POLL_INTERVAL = 1.0
+
+@st.cache_resource
+def get_job_manager():
+    """Менеджер фоновых заданий, один на процесс для всех сессий"""
+    return jobs.JobManager()
 
 # Настраиваем Tesseract при запуске
 tesseract_available = setup_tesseract()
@@ -113,251 +105,179 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 class PDFProcessor:
-    def __init__(self):
-        self.temp_dir = tempfile.mkdtemp()
-        
-    def find_order_number_ultra_fast(self, text):
-        """Поиск номера заказа в тексте - ОПТИМИЗИРОВАННЫЙ"""
-        patterns = [
-            r'\b(202[4-9]\d{6})\b',  # 2024XXXXXX
-            r'\b(20\d{8})\b',        # 20XXXXXXXX  
-            r'\b(\d{10})\b',         # Любые 10 цифр
-            r'\b(\d{8,12})\b',       # 8-12 цифр
-            r'\b(ORDER[:\\s]*)(\d{8,12})\b',  # ORDER: 12345678
-            r'\b(№[:\\s]*)(\d{8,12})\b',      # № 12345678
-        ]
+    def start_processing(self, pdf_file, workers=None, roi=pdf_engine.OCR_ROI, ocr_mode='text', profile=None):
+        """Запускает обработку PDF фоновым заданием, возвращает номер задания"""
+        # Страницы обрабатываются параллельно в отдельных процессах,
+        # задание живет независимо от перезапусков скрипта и соединения браузера
+        return get_job_manager().submit(
+            pdf_engine.upload_buffer(pdf_file),
+            pdf_file.name,
+            tesseract_available,
+            workers=workers,
+            roi=roi,
+            ocr_mode=ocr_mode,
+            # Повторная загрузка того же файла берет результаты страниц из кэша
+            cache_path=pdf_engine.RESULT_CACHE_PATH,
+            profile=profile
+        )
         
-        for pattern in patterns:
-            matches = re.findall(pattern, text, re.IGNORECASE)
-            if matches:
-                # Возвращаем последнюю группу (номер)
-                if isinstance(matches[0], tuple):
-                    for match in matches[0]:
-                        if match and match.isdigit():
-                            return match
-                else:
-                    return matches[0]
-        return None
+    def show_download_link(self, file_path, link_text):
+        """Кнопка или ссылка для скачивания файла"""
+        # С настроенным сервером файл отдается с диска кусками, без base64 в памяти
+        download_server.show_download(
+            file_path, link_text,
+            style="background-color: #4CAF50; color: white; padding: 12px 24px; text-decoration: none; border-radius: 8px; display: inline-block; font-weight: bold;"
+        )
 
-    def extract_text_optimized(self, page):
-        """Оптимизированное извлечение текста из PDF"""
-        try:
-            # Пробуем разные методы извлечения текста
-            text_methods = []
-            
-            # 1. Быстрый метод
-            text_raw = page.get_text("text")
-            if text_raw and len(text_raw) > 10:
-                text_methods.append(text_raw)
-            
-            # 2. Метод слов (более точный)
-            words = page.get_text("words")
-            if words:
-                text_words = " ".join([word[4] for word in words if len(word) > 4])
-                text_methods.append(text_words)
-            
-            # 3. Метод блоков
-            blocks = page.get_text("blocks")  
-            if blocks:
-                text_blocks = " ".join([block[4] for block in blocks if len(block) > 4])
-                text_methods.append(text_blocks)
-            
-            combined_text = " ".join(text_methods)
-            return combined_text
-            
-        except Exception as e:
-            return ""
+def show_progress(job):
+    """Прогресс выполняющегося задания и уже готовые файлы"""
+    stats = job['stats']
+    processed, total_pages = job['processed'], job['total']
+    
+    st.progress(processed / total_pages if total_pages else 0)
+    
+    if job['status'] == "queued":
+        st.info("⏳ Задание в очереди")
+        return
+        
+    # Скорость и ETA считает ProgressReporter движка
+    progress = stats.get('progress', {})
+    eta = progress.get('eta')
+    
+    st.text(
+        f"📊 Обработано: {processed}/{total_pages} | "
+        f"⚡ Скорость: {progress.get('recent_speed', 0):.1f} стр/сек | "
+        f"⏳ Осталось: {f'~{eta:.0f}с' if eta is not None else '—'} | "
+        f"✅ Текст: {stats.get('direct', 0)} | "
+        f"🔍 OCR: {stats.get('ocr', 0)} | "
+        f"❌ Не найдено: {stats.get('failed', 0)}"
+    )
+    if progress.get('rates'):
+        st.caption(" | ".join(f"{stage}: {rate:.1f} стр/сек" for stage, rate in progress['rates'].items()))
+    
+    if stats['files']:
+        with st.expander(f"📋 Готовые файлы: {len(stats['files'])}"):
+            for file_info in stats['files'][-50:]:
+                st.write(f"Страница {file_info['page']}: `{file_info['filename']}`")
 
-    def process_page_fast(self, page_num, page):
-        """Быстрая обработка одной страницы"""
-        if stop_processing.is_set():
-            return None, "stopped", page_num
+def show_report(stats, zip_path):
+    """Детальный отчет по завершенному заданию"""
+    st.markdown("---")
+    st.subheader("📊 Детальный отчет")
+    
+    # Основные метрики
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Всего страниц", stats['total'])
+    with col2:
+        st.metric("Найдено текстом", stats['direct'])
+    with col3:
+        st.metric("Найдено OCR", stats['ocr'])
+    with col4:
+        st.metric("Не найдено", stats['failed'])
         
-        try:
-            # Шаг 1: Быстрое извлечение текста (ОЧЕНЬ БЫСТРО)
-            text_direct = self.extract_text_optimized(page)
-            order_no = self.find_order_number_ultra_fast(text_direct)
-            
-            if order_no:
-                return order_no, "direct", page_num
-            
-            # Шаг 2: OCR если доступен (медленнее, но точнее)
-            if tesseract_available and not order_no:
-                try:
-                    # ОПТИМИЗИРОВАННОЕ создание изображения
-                    pix = page.get_pixmap(matrix=fitz.Matrix(1.2, 1.2))  # Низкое разрешение для скорости
-                    img_data = pix.tobytes("png")  # PNG быстрее
-                    img = Image.open(io.BytesIO(img_data))
-                    
-                    # Минимальная обработка изображения
-                    img = img.convert('L')  # Grayscale
-                    
-                    # ОПТИМИЗИРОВАННЫЙ OCR с быстрыми настройками
-                    ocr_text = pytesseract.image_to_string(
-                        img, 
-                        lang='eng',
-                        config='--oem 1 --psm 6 -c preserve_interword_spaces=0'
-                    )
-                    
-                    order_no = self.find_order_number_ultra_fast(ocr_text)
-                    if order_no:
-                        return order_no, "ocr", page_num
-                        
-                except Exception as e:
-                    return None, "ocr_error", page_num
+    # Дополнительная статистика
+    col_time, col_rate, col_stopped = st.columns(3)
+    with col_time:
+        st.metric("Общее время", f"{stats['total_time']:.1f}с")
+    with col_rate:
+        st.metric("Успешность", f"{stats['success_rate']:.1f}%")
+    with col_stopped:
+        if stats['stopped'] > 0:
+            st.metric("Остановлено", stats['stopped'])
             
-            return None, "not_found", page_num
-            
-        except Exception as e:
-            return None, "error", page_num
-
-    def process_pdf_optimized(self, pdf_file, progress_bar, status_text):
-        """ОПТИМИЗИРОВАННАЯ обработка PDF"""
-        global stop_processing
-        stop_processing = StopProcessing()
+    if stats['stopped'] > 0:
+        st.warning(f"⏹️ Обработка была остановлена! {stats['stopped']} страниц не обработано.")
         
-        start_time = time.time()
+    if stats.get('cache_hits'):
+        st.info(f"♻️ Из кэша: {stats['cache_hits']} страниц (без повторного OCR)")
+    
+    if stats.get('resumed'):
+        st.info(f"▶️ Из журнала прерванного запуска: {stats['resumed']} страниц")
         
-        # Сохраняем временный файл
-        temp_pdf_path = os.path.join(self.temp_dir, "input.pdf")
-        with open(temp_pdf_path, "wb") as f:
-            f.write(pdf_file.getvalue())
+    ocr_skipped = stats.get('ocr_skipped', {})
+    if ocr_skipped.get('pages'):
+        saved = ocr_skipped.get('saved_ms')
+        st.info(
+            f"📄 Без OCR (полный текстовый слой): {ocr_skipped['pages']} страниц"
+            + (f", сэкономлено ~{saved / 1000:.1f}с" if saved else "")
+        )
         
-        try:
-            # Открываем PDF
-            doc = fitz.open(temp_pdf_path)
-            total_pages = len(doc)
-            
-            # Создаем временную папку для результатов
-            output_dir = os.path.join(self.temp_dir, "output")
-            os.makedirs(output_dir, exist_ok=True)
-            
-            # Статистика
-            stats = {
-                'total': total_pages,
-                'direct': 0,
-                'ocr': 0,
-                'failed': 0,
-                'stopped': 0,
-                'files': [],
-                'success_rate': 0,
-                'total_time': 0
-            }
-            
-            # Обрабатываем страницы с прогрессом
-            for page_num in range(total_pages):
-                if stop_processing.is_set():
-                    stats['stopped'] = total_pages - page_num
-                    break
-                
-                page_start_time = time.time()
-                
-                page = doc[page_num]
-                order_no, method, _ = self.process_page_fast(page_num, page)
-                
-                # Создаем отдельный PDF
-                new_doc = fitz.open()
-                new_doc.insert_pdf(doc, from_page=page_num, to_page=page_num)
-                
-                # Генерируем имя файла
-                if order_no:
-                    filename = f"{order_no}.pdf"
-                else:
-                    filename = f"page_{page_num + 1}.pdf"
-                
-                output_path = os.path.join(output_dir, filename)
-                
-                # Избегаем перезаписи
-                counter = 1
-                base_name = os.path.splitext(filename)[0]
-                while os.path.exists(output_path):
-                    output_path = os.path.join(output_dir, f"{base_name}_{counter}.pdf")
-                    counter += 1
-                
-                new_doc.save(output_path)
-                new_doc.close()
-                
-                # Обновляем статистику
-                if order_no:
-                    if method == "direct":
-                        stats['direct'] += 1
-                    else:
-                        stats['ocr'] += 1
-                else:
-                    stats['failed'] += 1
-                
-                stats['files'].append({
-                    'filename': os.path.basename(output_path),
-                    'page': page_num + 1,
-                    'method': method,
-                    'order_no': order_no
-                })
-                
-                # Обновляем прогресс
-                progress = (page_num + 1) / total_pages
-                progress_bar.progress(progress)
+    ocr_cache = stats.get('ocr_cache', {})
+    if ocr_cache.get('hits') or ocr_cache.get('near_hits'):
+        st.info(
+            f"🔁 Повторные растры OCR: {ocr_cache['hits'] + ocr_cache['near_hits']} из кэша, "
+            f"{ocr_cache['misses']} распознано"
+        )
+        
+    # Время извлечения текста по видам
+    if stats.get('text_views'):
+        with st.expander("⏱️ Время извлечения текста"):
+            for view, timing in stats['text_views'].items():
+                st.write(
+                    f"`{view}`: {timing['ms']:.0f} мс | "
+                    f"вызовов: {timing['calls']} | "
+                    f"совпадений: {timing['hits']}"
+                )
                 
-                elapsed = time.time() - start_time
-                speed = (page_num + 1) / elapsed if elapsed > 0 else 0
-                processed = page_num + 1
+    # Ступени OCR: где нашелся уверенный номер
+    if stats.get('ocr_levels'):
+        with st.expander("🔍 Ступени OCR (область@масштаб)"):
+            for level, timing in stats['ocr_levels'].items():
+                st.write(
+                    f"`{level}`: {timing['ms']:.0f} мс | "
+                    f"вызовов: {timing['calls']} | "
+                    f"уверенных номеров: {timing['hits']}"
+                )
                 
-                status_text.text(
-                    f"📊 Обработано: {processed}/{total_pages} | "
-                    f"⚡ Скорость: {speed:.1f} стр/сек | "
-                    f"✅ Текст: {stats['direct']} | "
-                    f"🔍 OCR: {stats['ocr']} | "
-                    f"❌ Не найдено: {stats['failed']}"
+    # Время по этапам на страницу: где уходит время задания
+    if stats.get('stages'):
+        with st.expander("⏱️ Время по этапам (мс на страницу)"):
+            for stage, timing in stats['stages'].items():
+                st.write(
+                    f"`{stage}`: p50 {timing['p50']:.1f} | "
+                    f"p95 {timing['p95']:.1f} | "
+                    f"max {timing['max']:.1f} | "
+                    f"всего {timing['total_ms'] / 1000:.1f}с на {timing['pages']} стр."
+                )
+            col_json, col_csv = st.columns(2)
+            with col_json:
+                st.download_button("JSON", pdf_engine.stage_report_json(stats['stages']),
+                                   file_name="stages.json", mime="application/json")
+            with col_csv:
+                st.download_button("CSV", pdf_engine.stage_report_csv(stats['stages']),
+                                   file_name="stages.csv", mime="text/csv")
+            if stats.get('profile') and os.path.exists(stats['profile']):
+                download_server.show_download(
+                    stats['profile'], "⬇️ Профиль задания",
+                    filename=os.path.basename(stats['profile'])
                 )
-            
-            doc.close()
-            
-            # Создаем ZIP архив
-            if stats['files']:
-                zip_path = os.path.join(self.temp_dir, "results.zip")
-                with zipfile.ZipFile(zip_path, 'w') as zipf:
-                    for file_info in stats['files']:
-                        file_path = os.path.join(output_dir, file_info['filename'])
-                        if os.path.exists(file_path):
-                            zipf.write(file_path, file_info['filename'])
                 
-                stats['zip_path'] = zip_path
-            
-            # Расчет статистики
-            total_time = time.time() - start_time
-            stats['total_time'] = total_time
-            
-            success_count = stats['direct'] + stats['ocr']
-            stats['success_rate'] = (success_count / stats['total']) * 100 if stats['total'] > 0 else 0
-            
-            return stats
-            
-        except Exception as e:
-            st.error(f"❌ Ошибка обработки PDF: {str(e)}")
-            import traceback
-            st.error(f"Детали: {traceback.format_exc()}")
-            return None
+    # Скачивание результатов
+    if zip_path:
+        st.markdown("---")
+        st.subheader("📥 Скачать результаты")
+        st.session_state.processor.show_download_link(zip_path, "⬇️ Скачать ZIP архив с PDF файлами")
+        
+    # Список файлов
+    with st.expander("📋 Показать список созданных файлов"):
+        for file_info in stats['files']:
+            method_icon = "✅" if file_info['method'] == 'direct' else "🔍" if file_info['method'] == 'ocr' else "❌"
+            st.write(f"{method_icon} Страница {file_info['page']}: `{file_info['filename']}`")
 
-    def get_download_link(self, file_path, link_text):
-        """Создает ссылку для скачивания файла"""
-        if not file_path or not os.path.exists(file_path):
-            return "❌ Файл не найден"
-            
-        with open(file_path, "rb") as f:
-            data = f.read()
-        b64 = base64.b64encode(data).decode()
-        href = f'<a href="data:application/zip;base64,{b64}" download="pdf_results.zip" style="background-color: #4CAF50; color: white; padding: 12px 24px; text-decoration: none; border-radius: 8px; display: inline-block; font-weight: bold;">{link_text}</a>'
-        return href
+def stop_current_job():
+    job_id = st.session_state.get('job_id')
+    if job_id and get_job_manager().cancel(job_id):
+        st.warning("Обработка будет остановлена!")
 
 def main():
-    global stop_processing
-    
     # Заголовок приложения
     st.markdown('<div class="main-header">📄 PDF Splitter - Ultra Rapid</div>', unsafe_allow_html=True)
     
     # Инициализация процессора
     if 'processor' not in st.session_state:
         st.session_state.processor = PDFProcessor()
-    
+        
     # Боковая панель с информацией
     with st.sidebar:
         st.header("ℹ️ Информация")
@@ -371,11 +291,50 @@ def main():
             st.warning("⚠️ Tesseract не доступен")
             st.info("Режим: Только текст")
             
+        workers = st.slider(
+            "⚙️ Процессов обработки",
+            min_value=1,
+            max_value=max(2, pdf_engine.default_workers()),
+            value=pdf_engine.default_workers()
+        )
+        roi_ocr = st.checkbox(
+            "🎯 OCR сначала только по шапке страницы",
+            value=True,
+            help="Область номера уточняется по страницам, где номер найден текстом"
+        )
+        number_ocr = st.checkbox(
+            "🔢 OCR только цифр номера",
+            value=False,
+            help="Белый список цифр и распознавание по строкам вместо полного текста"
+        )
+        profile_job = st.checkbox(
+            "🔬 Профилировать задание (cProfile)",
+            value=False,
+            help="Профиль вместе с процессами-воркерами, ссылка в отчете по этапам"
+        )
+        
         st.markdown("---")
         if st.button("🛑 Экстренная остановка", use_container_width=True):
-            stop_processing.set()
-            st.warning("Обработка будет остановлена!")
-
+            stop_current_job()
+            
+        # Задания продолжаются без браузера - к ним можно вернуться.
+        # Менеджер общий для всех посетителей, поэтому в списке только задания этой сессии,
+        # чужое задание открывается лишь по его номеру
+        st.markdown("---")
+        recent_jobs = [job for job in get_job_manager().list_jobs() if job['id'] in st.session_state.get('my_jobs', ())]
+        if recent_jobs:
+            labels = {job['id']: f"{job['filename']} ({job['status']}, {job['processed']}/{job['total']})" for job in recent_jobs}
+            selected_job = st.selectbox("📂 Задания", list(labels), format_func=labels.get)
+            if st.button("Открыть задание", use_container_width=True):
+                st.session_state.job_id = selected_job
+        typed_job = st.text_input("🔑 Номер задания", help="Номер показан над прогрессом задания").strip()
+        if typed_job and st.button("Открыть по номеру", use_container_width=True):
+            if get_job_manager().get(typed_job) is not None:
+                st.session_state.job_id = typed_job
+                st.session_state.setdefault('my_jobs', []).append(typed_job)
+            else:
+                st.error("❌ Задание не найдено")
+                
     # Основная область
     col1, col2 = st.columns([2, 1])
     
@@ -395,74 +354,44 @@ def main():
             
             with col_btn1:
                 process_clicked = st.button("🚀 Начать обработку", type="primary", use_container_width=True)
-            
+                
             with col_btn2:
                 stop_clicked = st.button("🛑 Остановить", use_container_width=True)
-            
+                
             if stop_clicked:
-                stop_processing.set()
-                st.warning("Обработка остановлена!")
-            
+                stop_current_job()
+                
             if process_clicked:
-                # Элементы интерфейса
-                progress_bar = st.progress(0)
-                status_text = st.empty()
-                results_placeholder = st.empty()
+                st.session_state.job_id = st.session_state.processor.start_processing(
+                    uploaded_file,
+                    workers=workers,
+                    roi=pdf_engine.OCR_ROI if roi_ocr else None,
+                    ocr_mode='number' if number_ocr else 'text',
+                    profile="cprofile" if profile_job else None
+                )
+                st.session_state.setdefault('my_jobs', []).append(st.session_state.job_id)
                 
-                # Обработка PDF
-                with st.spinner("🔄 Обработка PDF..."):
-                    stats = st.session_state.processor.process_pdf_optimized(
-                        uploaded_file, 
-                        progress_bar, 
-                        status_text
-                    )
+        # Состояние задания берется у менеджера при каждом перезапуске скрипта
+        job_id = st.session_state.get('job_id')
+        job = get_job_manager().get(job_id) if job_id else None
+        if job is not None:
+            st.caption(f"Задание `{job['id']}`: {job['filename']} (номер нужен, чтобы вернуться к заданию из другой вкладки)")
+            if job['status'] in jobs.ACTIVE_STATUSES:
+                show_progress(job)
+            elif job['status'] == "failed":
+                st.error(f"❌ Ошибка обработки PDF: {job['error']}")
+            elif job['status'] == "interrupted":
+                st.error("❌ Задание прервано перезапуском сервера")
+            else:
+                show_report(job['stats'], job['zip_path'])
+            
+            # Готовые страницы берутся из журнала задания, анализируются только остальные
+            if job['status'] in jobs.RESUMABLE_STATUSES:
+                if st.button("▶️ Продолжить с места остановки", use_container_width=True):
+                    if get_job_manager().resume(job['id']):
+                        st.rerun()
+                    st.error("❌ Задание нельзя продолжить: входной файл уже удален, загрузите PDF заново")
                 
-                if stats:
-                    # Детальный отчет
-                    with results_placeholder.container():
-                        st.markdown("---")
-                        st.subheader("📊 Детальный отчет")
-                        
-                        # Основные метрики
-                        col1, col2, col3, col4 = st.columns(4)
-                        with col1:
-                            st.metric("Всего страниц", stats['total'])
-                        with col2:
-                            st.metric("Найдено текстом", stats['direct'])
-                        with col3:
-                            st.metric("Найдено OCR", stats['ocr'])
-                        with col4:
-                            st.metric("Не найдено", stats['failed'])
-                        
-                        # Дополнительная статистика
-                        col_time, col_rate, col_stopped = st.columns(3)
-                        with col_time:
-                            st.metric("Общее время", f"{stats['total_time']:.1f}с")
-                        with col_rate:
-                            st.metric("Успешность", f"{stats['success_rate']:.1f}%")
-                        with col_stopped:
-                            if stats['stopped'] > 0:
-                                st.metric("Остановлено", stats['stopped'])
-                        
-                        if stats['stopped'] > 0:
-                            st.warning(f"⏹️ Обработка была остановлена! {stats['stopped']} страниц не обработано.")
-                        
-                        # Скачивание результатов
-                        if stats.get('zip_path'):
-                            st.markdown("---")
-                            st.subheader("📥 Скачать результаты")
-                            download_link = st.session_state.processor.get_download_link(
-                                stats['zip_path'], 
-                                "⬇️ Скачать ZIP архив с PDF файлами"
-                            )
-                            st.markdown(download_link, unsafe_allow_html=True)
-                        
-                        # Список файлов
-                        with st.expander("📋 Показать список созданных файлов"):
-                            for file_info in stats['files']:
-                                method_icon = "✅" if file_info['method'] == 'direct' else "🔍" if file_info['method'] == 'ocr' else "❌"
-                                st.write(f"{method_icon} Страница {file_info['page']}: `{file_info['filename']}`")
-    
     with col2:
         st.subheader("⚡ Быстрый старт")
         st.markdown("""
@@ -477,7 +406,13 @@ def main():
         - ⏹️ Остановка в любой момент
         - 📊 Детальная статистика
         - ⚡ Высокая скорость
+        - 🔄 Обработка продолжается при закрытой вкладке
         """)
+        
+    # Пока задание идет - опрашиваем его, скрипт ничего не обрабатывает сам
+    if job is not None and job['status'] in jobs.ACTIVE_STATUSES:
+        time.sleep(POLL_INTERVAL)
+        st.rerun()
 
 if __name__ == "__main__":
     main()
@@ -6,9 +6,10 @@ import re
 import tempfile
 import os
 import zipfile
-import base64
 import time
 import pytesseract 
+import download_server
+import pdf_engine
 
 # Настройка страницы
 st.set_page_config(
@@ -175,14 +176,9 @@ class PDFProcessor:
         
         start_time = time.time()
         
-        # Сохраняем временный файл
-        temp_pdf_path = os.path.join(self.temp_dir, "input.pdf")
-        with open(temp_pdf_path, "wb") as f:
-            f.write(pdf_file.getvalue())
-        
         try:
-            # Открываем PDF
-            doc = fitz.open(temp_pdf_path)
+            # Открываем PDF прямо из буфера загрузки, без копии и временного файла
+            doc = fitz.open(stream=pdf_file.getbuffer(), filetype="pdf")
             total_pages = len(doc)
             
             # Создаем временную папку для результатов
@@ -199,6 +195,23 @@ class PDFProcessor:
                 'files': [],
                 'processing_times': []
             }
+            # Время этапов на страницу, мс: p50/p95/max в отчете
+            stage_samples = {'analyze': [], 'split': [], 'zip': []}
+            
+            def show_progress(progress):
+                # Сообщения в браузер не чаще 5 раз в секунду, а не на каждой странице
+                progress_bar.progress(progress['processed'] / total_pages)
+                eta = progress['eta']
+                
+                status_text.text(
+                    f"📊 Обработано: {progress['processed']}/{total_pages} | "
+                    f"⚡ Скорость: {progress['recent_speed']:.1f} стр/сек | "
+                    f"⏳ Осталось: {f'~{eta:.0f}с' if eta is not None else '—'} | "
+                    f"✅ Текст: {stats['direct']} | "
+                    f"🔍 OCR: {stats['ocr']}"
+                )
+            
+            reporter = pdf_engine.ProgressReporter(show_progress, total_pages)
             
             # Обрабатываем страницы
             for page_num in range(total_pages):
@@ -210,6 +223,8 @@ class PDFProcessor:
                 
                 page = doc[page_num]
                 order_no, method, _ = self.process_page_fast(page_num, page)
+                split_start = time.time()
+                stage_samples['analyze'].append((split_start - page_start_time) * 1000)
                 
                 # Создаем отдельный PDF
                 new_doc = fitz.open()
@@ -232,6 +247,7 @@ class PDFProcessor:
                 
                 new_doc.save(output_path)
                 new_doc.close()
+                stage_samples['split'].append((time.time() - split_start) * 1000)
                 
                 # Обновляем статистику
                 if order_no:
@@ -253,19 +269,9 @@ class PDFProcessor:
                 stats['processing_times'].append(page_time)
                 
                 # Обновляем прогресс
-                progress = (page_num + 1) / total_pages
-                progress_bar.progress(progress)
-                
-                elapsed = time.time() - start_time
-                speed = (page_num + 1) / elapsed if elapsed > 0 else 0
-                
-                status_text.text(
-                    f"📊 Обработано: {page_num + 1}/{total_pages} | "
-                    f"⚡ Скорость: {speed:.1f} стр/сек | "
-                    f"✅ Текст: {stats['direct']} | "
-                    f"🔍 OCR: {stats['ocr']}"
-                )
+                reporter.page(method)
             
+            reporter.close()
             doc.close()
             
             # Создаем ZIP архив
@@ -275,7 +281,9 @@ class PDFProcessor:
                     for file_info in stats['files']:
                         file_path = os.path.join(output_dir, file_info['filename'])
                         if os.path.exists(file_path):
+                            zip_start = time.time()
                             zipf.write(file_path, file_info['filename'])
+                            stage_samples['zip'].append((time.time() - zip_start) * 1000)
                 
                 stats['zip_path'] = zip_path
             else:
@@ -283,6 +291,8 @@ class PDFProcessor:
             
             total_time = time.time() - start_time
             stats['total_time'] = total_time
+            stage_samples['page'] = [page_time * 1000 for page_time in stats['processing_times']]
+            stats['stages'] = pdf_engine.stage_summary(stage_samples)
             
             return stats
             
@@ -290,16 +300,13 @@ class PDFProcessor:
             st.error(f"❌ Ошибка обработки PDF: {str(e)}")
             return None
 
-    def get_download_link(self, file_path, link_text):
-        """Создает ссылку для скачивания файла"""
-        if not file_path or not os.path.exists(file_path):
-            return "Файл не найден"
-            
-        with open(file_path, "rb") as f:
-            data = f.read()
-        b64 = base64.b64encode(data).decode()
-        href = f'<a href="data:application/zip;base64,{b64}" download="pdf_results.zip" style="background-color: #4CAF50; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px; display: inline-block;">{link_text}</a>'
-        return href
+    def show_download_link(self, file_path, link_text):
+        """Кнопка или ссылка для скачивания файла"""
+        # С настроенным сервером файл отдается с диска кусками, без base64 в памяти
+        download_server.show_download(
+            file_path, link_text,
+            style="background-color: #4CAF50; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px; display: inline-block;"
+        )
 
 def main():
     global stop_processing
@@ -384,15 +391,22 @@ def main():
                             
                             st.metric("Общее время", f"{stats['total_time']:.1f} сек")
                             
+                            if stats['stages']:
+                                with st.expander("⏱️ Время по этапам (мс на страницу)"):
+                                    for stage, timing in stats['stages'].items():
+                                        st.write(
+                                            f"`{stage}`: p50 {timing['p50']:.1f} | "
+                                            f"p95 {timing['p95']:.1f} | "
+                                            f"max {timing['max']:.1f}"
+                                        )
+                                    st.download_button("CSV", pdf_engine.stage_report_csv(stats['stages']),
+                                                       file_name="stages.csv", mime="text/csv")
+                            
                             # Скачивание
                             if stats.get('zip_path'):
                                 st.markdown("---")
                                 st.subheader("📥 Скачать результаты")
-                                download_link = st.session_state.processor.get_download_link(
-                                    stats['zip_path'], 
-                                    "⬇️ Скачать ZIP архив"
-                                )
-                                st.markdown(download_link, unsafe_allow_html=True)
+                                st.session_state.processor.show_download_link(stats['zip_path'], "⬇️ Скачать ZIP архив")
     
     with col2:
         st.subheader("⚡ Быстрый старт")
@@ -7,11 +7,13 @@ import re
 import tempfile
 import os
 import zipfile
-import base64
 import time
 import subprocess
 import concurrent.futures
+import threading
 from threading import Lock
+import pdf_engine
+import download_server
 
 # Настройка страницы
 st.set_page_config(
@@ -36,6 +38,17 @@ def setup_tesseract():
 # Инициализация
 tesseract_available = setup_tesseract()
 
+# Долгоживущий пул потоков для страниц
+PAGE_WORKERS = 4  # Оптимально для Streamlit Cloud
+OCR_TIMEOUT = 60  # Секунд на страницу: зависший tesseract не держит поток пула
+
+@st.cache_resource
+def get_page_pool():
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=PAGE_WORKERS,
+        thread_name_prefix="pdf-page"
+    )
+
 # Глобальные переменные
 class ProcessingState:
     def __init__(self):
@@ -54,7 +67,13 @@ class ProcessingState:
         with self._lock:
             self._stop = False
 
-processing_state = ProcessingState()
+# Скрипт выполняется заново при каждом нажатии кнопки: новый объект на уровне модуля
+# кнопка СТОП переключила бы вместо того, что проверяют потоки пула.
+# Состояние свое у каждого запуска и хранится в сессии - остановка не задевает чужие сессии
+def stop_current_run():
+    state = st.session_state.get('processing_state')
+    if state is not None:
+        state.stop()
 
 # CSS
 st.markdown("""
@@ -80,6 +99,9 @@ class PDFProcessor:
     def __init__(self):
         self.temp_dir = tempfile.mkdtemp()
         self._pattern_cache = {}
+        self._shared_pdf = None
+        # Дескрипторы документа потоков пула текущего запуска: {id потока: документ}
+        self._thread_docs = {}
         
     def _compile_patterns(self):
         """Кэшируем regex patterns для скорости"""
@@ -130,27 +152,42 @@ class PDFProcessor:
         except:
             return ""
 
+    def _thread_document(self):
+        """Свой дескриптор документа для каждого потока из общего буфера"""
+        thread_id = threading.get_ident()
+        doc = self._thread_docs.get(thread_id)
+        if doc is None:
+            doc = self._thread_docs[thread_id] = self._shared_pdf.open_document()
+        return doc
+
+    def _close_documents(self):
+        """Закрывает дескрипторы запуска: пул постоянный, иначе потоки держали бы буфер прошлой загрузки"""
+        for doc in self._thread_docs.values():
+            doc.close()
+        # Закрытый документ все еще ссылается на буфер - ссылки убираются совсем
+        self._thread_docs = {}
+
     def process_single_page(self, args):
         """Обработка одной страницы для многопоточности"""
-        page_num, page_data, use_ocr = args
+        page_num, use_ocr, processing_state = args
         
         if processing_state.should_stop():
             return None, "stopped", page_num
         
         try:
-            # Создаем временный документ для этой страницы
-            doc = fitz.open("pdf", page_data)
-            page = doc[0]
+            page = self._thread_document()[page_num]
             
             # Шаг 1: Сверхбыстрое извлечение текста
             text = self.extract_text_super_fast(page)
             order_no = self.find_order_number_ultra_fast(text)
             
             if order_no:
-                doc.close()
                 return order_no, "direct", page_num
             
             # Шаг 2: OCR только если действительно нужно
+            if processing_state.should_stop():
+                return None, "stopped", page_num
+            
             if use_ocr and not order_no:
                 try:
                     # Сверхоптимизированное создание изображения
@@ -161,24 +198,26 @@ class PDFProcessor:
                     img = Image.open(io.BytesIO(img_data))
                     img = img.convert('L')
                     
-                    # Ультра-быстрый OCR с минимальными настройками
-                    ocr_text = pytesseract.image_to_string(
+                    # Ультра-быстрый OCR с минимальными настройками;
+                    # по СТОП процесс tesseract убивается, а не дорабатывает страницу
+                    ocr_text = pdf_engine.image_to_string_cancellable(
                         img, 
                         lang='eng',
-                        config='--oem 1 --psm 6 -c tessedit_do_invert=0'
+                        config='--oem 1 --psm 6 -c tessedit_do_invert=0',
+                        should_stop=processing_state.should_stop,
+                        timeout=OCR_TIMEOUT
                     )
+                    if ocr_text is None:
+                        return None, "stopped" if processing_state.should_stop() else "ocr_error", page_num
                     
                     order_no = self.find_order_number_ultra_fast(ocr_text)
-                    doc.close()
                     
                     if order_no:
                         return order_no, "ocr", page_num
                         
                 except Exception as e:
-                    doc.close()
                     return None, "ocr_error", page_num
             
-            doc.close()
             return None, "not_found", page_num
             
         except Exception as e:
@@ -186,29 +225,20 @@ class PDFProcessor:
 
     def process_pdf_ultra_fast(self, pdf_file, progress_bar, status_text):
         """УЛЬТРА-БЫСТРАЯ обработка с многопоточностью"""
-        processing_state.reset()
+        processing_state = ProcessingState()
+        st.session_state.processing_state = processing_state
         start_time = time.time()
-        
-        # Сохраняем PDF
-        temp_pdf_path = os.path.join(self.temp_dir, "input.pdf")
-        with open(temp_pdf_path, "wb") as f:
-            f.write(pdf_file.getvalue())
+        main_doc = None
+        pending = {}
         
         try:
-            # Открываем основной PDF один раз
-            main_doc = fitz.open(temp_pdf_path)
+            # Буфер загрузки используется как есть, потоки открывают из него свои дескрипторы
+            self._shared_pdf = pdf_engine.SharedPDFBuffer(pdf_engine.upload_buffer(pdf_file))
+            main_doc = self._shared_pdf.open_document()
             total_pages = len(main_doc)
             
             # Подготавливаем данные страниц для многопоточности
-            page_data_list = []
-            for page_num in range(total_pages):
-                if processing_state.should_stop():
-                    break
-                # Получаем raw данные страницы
-                page_data = main_doc[page_num].get_contents()
-                page_data_list.append((page_num, page_data, tesseract_available))
-            
-            main_doc.close()
+            page_data_list = [(page_num, tesseract_available, processing_state) for page_num in range(total_pages)]
             
             output_dir = os.path.join(self.temp_dir, "output")
             os.makedirs(output_dir, exist_ok=True)
@@ -224,91 +254,100 @@ class PDFProcessor:
                 'pages_processed': 0
             }
             
-            # МНОГОПОТОЧНАЯ обработка
+            def show_progress(progress):
+                # Каждый вызов - сообщение в браузер, поэтому не чаще 5 раз в секунду
+                progress_bar.progress(progress['processed'] / total_pages)
+                eta = progress['eta']
+                
+                status_text.text(
+                    f"🚀 Обработано: {progress['processed']}/{total_pages} | "
+                    f"⚡ СКОРОСТЬ: {progress['recent_speed']:.1f} стр/сек | "
+                    f"⏳ Осталось: {f'~{eta:.0f}с' if eta is not None else '—'} | "
+                    f"✅ Текст: {stats['direct']} | "
+                    f"🔍 OCR: {stats['ocr']} | "
+                    f"❌ Не найдено: {stats['failed']}"
+                )
+            
+            reporter = pdf_engine.ProgressReporter(show_progress, total_pages)
+            
+            # МНОГОПОТОЧНАЯ обработка в постоянном пуле
             completed_pages = 0
-            batch_size = 4  # Оптимальный размер батча для Streamlit Cloud
+            executor = get_page_pool()
+            max_in_flight = PAGE_WORKERS * 2  # Ограниченная очередь задач
+            pages_to_submit = iter(page_data_list)
             
-            for batch_start in range(0, len(page_data_list), batch_size):
+            def refill():
+                # Свободный поток сразу получает следующую страницу; предел проверяется до выдачи,
+                # иначе каждый таймаут wait() без готовых страниц добавлял бы по задаче
+                while len(pending) < max_in_flight and (page_data := next(pages_to_submit, None)) is not None:
+                    pending[executor.submit(self.process_single_page, page_data)] = page_data
+            
+            refill()
+            while pending:
                 if processing_state.should_stop():
-                    stats['stopped'] = len(page_data_list) - completed_pages
+                    for future in pending:
+                        future.cancel()
+                    stats['stopped'] = total_pages - completed_pages
                     break
                 
-                batch_end = min(batch_start + batch_size, len(page_data_list))
-                batch_data = page_data_list[batch_start:batch_end]
+                # С таймаутом: остановка замечается, пока страницы еще обрабатываются
+                done, _ = concurrent.futures.wait(
+                    pending, timeout=0.1, return_when=concurrent.futures.FIRST_COMPLETED
+                )
                 
-                # Обрабатываем батч страниц
-                with concurrent.futures.ThreadPoolExecutor(max_workers=batch_size) as executor:
-                    future_to_page = {
-                        executor.submit(self.process_single_page, page_data): page_data 
-                        for page_data in batch_data
-                    }
+                for future in done:
+                    page_data = pending.pop(future)
+                    page_num = page_data[0]
                     
-                    for future in concurrent.futures.as_completed(future_to_page):
-                        if processing_state.should_stop():
-                            break
-                            
-                        page_data = future_to_page[future]
-                        page_num = page_data[0]
+                    try:
+                        order_no, method, processed_page_num = future.result()
                         
-                        try:
-                            order_no, method, processed_page_num = future.result()
-                            
-                            # Создаем PDF для этой страницы
-                            doc = fitz.open(temp_pdf_path)
-                            new_doc = fitz.open()
-                            new_doc.insert_pdf(doc, from_page=page_num, to_page=page_num)
-                            
-                            # Генерируем имя файла
-                            filename = f"{order_no}.pdf" if order_no else f"page_{page_num + 1}.pdf"
-                            output_path = os.path.join(output_dir, filename)
-                            
-                            # Быстрая проверка уникальности
-                            counter = 1
-                            base_name = os.path.splitext(filename)[0]
-                            while os.path.exists(output_path):
-                                output_path = os.path.join(output_dir, f"{base_name}_{counter}.pdf")
-                                counter += 1
-                            
-                            new_doc.save(output_path)
-                            new_doc.close()
-                            doc.close()
-                            
-                            # Обновляем статистику
-                            if order_no:
-                                if method == "direct":
-                                    stats['direct'] += 1
-                                else:
-                                    stats['ocr'] += 1
+                        # Создаем PDF для этой страницы из уже открытого документа
+                        new_doc = fitz.open()
+                        new_doc.insert_pdf(main_doc, from_page=page_num, to_page=page_num)
+                        
+                        # Генерируем имя файла
+                        filename = f"{order_no}.pdf" if order_no else f"page_{page_num + 1}.pdf"
+                        output_path = os.path.join(output_dir, filename)
+                        
+                        # Быстрая проверка уникальности
+                        counter = 1
+                        base_name = os.path.splitext(filename)[0]
+                        while os.path.exists(output_path):
+                            output_path = os.path.join(output_dir, f"{base_name}_{counter}.pdf")
+                            counter += 1
+                        
+                        new_doc.save(output_path)
+                        new_doc.close()
+                        
+                        # Обновляем статистику
+                        if order_no:
+                            if method == "direct":
+                                stats['direct'] += 1
                             else:
-                                stats['failed'] += 1
-                            
-                            stats['files'].append({
-                                'filename': os.path.basename(output_path),
-                                'page': page_num + 1,
-                                'method': method,
-                                'order_no': order_no
-                            })
-                            
-                            completed_pages += 1
-                            stats['pages_processed'] = completed_pages
-                            
-                            # Обновляем прогресс
-                            progress = completed_pages / total_pages
-                            progress_bar.progress(progress)
-                            
-                            elapsed = time.time() - start_time
-                            speed = completed_pages / elapsed if elapsed > 0 else 0
-                            
-                            status_text.text(
-                                f"🚀 Обработано: {completed_pages}/{total_pages} | "
-                                f"⚡ СКОРОСТЬ: {speed:.1f} стр/сек | "
-                                f"✅ Текст: {stats['direct']} | "
-                                f"🔍 OCR: {stats['ocr']} | "
-                                f"❌ Не найдено: {stats['failed']}"
-                            )
-                            
-                        except Exception as e:
-                            continue
+                                stats['ocr'] += 1
+                        else:
+                            stats['failed'] += 1
+                        
+                        stats['files'].append({
+                            'filename': os.path.basename(output_path),
+                            'page': page_num + 1,
+                            'method': method,
+                            'order_no': order_no
+                        })
+                        
+                        completed_pages += 1
+                        stats['pages_processed'] = completed_pages
+                        
+                        # Обновляем прогресс
+                        reporter.page(method)
+                    
+                    except Exception as e:
+                        continue
+                
+                refill()
+            
+            reporter.close()
             
             # Создаем ZIP архив
             if stats['files']:
@@ -330,16 +369,27 @@ class PDFProcessor:
         except Exception as e:
             st.error(f"❌ Ошибка: {str(e)}")
             return None
+        
+        finally:
+            # Дескрипторы закрываются, когда их потоки уже отработали
+            for future in pending:
+                future.cancel()
+            concurrent.futures.wait(pending)
+            self._close_documents()
+            if main_doc is not None:
+                main_doc.close()
+                main_doc = None
+            if self._shared_pdf is not None:
+                self._shared_pdf.close()
+                self._shared_pdf = None
 
-    def get_download_link(self, file_path, link_text):
-        if not file_path or not os.path.exists(file_path):
-            return "❌ Файл не найден"
-            
-        with open(file_path, "rb") as f:
-            data = f.read()
-        b64 = base64.b64encode(data).decode()
-        href = f'<a href="data:application/zip;base64,{b64}" download="pdf_results.zip" style="background: linear-gradient(45deg, #FF6B6B, #4ECDC4); color: white; padding: 12px 24px; text-decoration: none; border-radius: 8px; display: inline-block; font-weight: bold;">{link_text}</a>'
-        return href
+    def show_download_link(self, file_path, link_text):
+        """Кнопка или ссылка для скачивания файла"""
+        # С настроенным сервером файл отдается с диска кусками, без base64 в памяти
+        download_server.show_download(
+            file_path, link_text,
+            style="background: linear-gradient(45deg, #FF6B6B, #4ECDC4); color: white; padding: 12px 24px; text-decoration: none; border-radius: 8px; display: inline-block; font-weight: bold;"
+        )
 
 def main():
     st.markdown('<div class="main-header">📄 PDF Splitter - ULTRA FAST</div>', unsafe_allow_html=True)
@@ -356,14 +406,14 @@ def main():
         - 🚀 Многопоточность
         - 💾 Кэширование regex
         - 🎯 Минимальный OCR
-        - 📦 Пакетная обработка
+        - ♻️ Постоянный пул потоков
         - 🔧 Оптимизированные настройки
         """)
         
         st.markdown(f"**OCR:** {'✅ Доступен' if tesseract_available else '❌ Не доступен'}")
         
         if st.button("🛑 СТОП", use_container_width=True, type="primary"):
-            processing_state.stop()
+            stop_current_run()
             st.warning("Остановка...")
 
     # Main area
@@ -417,14 +467,11 @@ def main():
                             # Скачивание
                             if stats.get('zip_path'):
                                 st.markdown("---")
-                                download_link = st.session_state.processor.get_download_link(
-                                    stats['zip_path'], "⬇️ СКАЧАТЬ РЕЗУЛЬТАТЫ"
-                                )
-                                st.markdown(download_link, unsafe_allow_html=True)
+                                st.session_state.processor.show_download_link(stats['zip_path'], "⬇️ СКАЧАТЬ РЕЗУЛЬТАТЫ")
             
             with col_stop:
                 if st.button("⏹️ СТОП", use_container_width=True):
-                    processing_state.stop()
+                    stop_current_run()
     
     with col2:
         st.subheader("🎯 Стратегия скорости")
@@ -433,7 +480,7 @@ def main():
         
         🚀 **Многопоточность**  
         - Параллельная обработка
-        - Батчи по 4 страницы
+        - Постоянный пул из 4 потоков
         
         💾 **Кэширование**  
         - Regex patterns
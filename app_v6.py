@@ -1,13 +1,14 @@
 import streamlit as st
 import fitz
 import pytesseract
+import download_server
+import pdf_engine
 from PIL import Image
 import io
 import re
 import tempfile
 import os
 import zipfile
-import base64
 import time
 import subprocess
 
@@ -138,13 +139,8 @@ class PDFProcessor:
         start_time = time.time()
         
         try:
-            # Сохраняем PDF во временный файл
-            temp_pdf_path = os.path.join(self.temp_dir, "input.pdf")
-            with open(temp_pdf_path, "wb") as f:
-                f.write(pdf_file.getvalue())
-            
-            # Открываем PDF
-            doc = fitz.open(temp_pdf_path)
+            # Открываем PDF прямо из буфера загрузки, без копии и временного файла
+            doc = fitz.open(stream=pdf_file.getbuffer(), filetype="pdf")
             total_pages = len(doc)
             
             # Создаем папку для результатов
@@ -160,6 +156,21 @@ class PDFProcessor:
                 'files': []
             }
             
+            def show_progress(progress):
+                # Прогресс и статус - сообщения в браузер, не чаще 5 раз в секунду
+                progress_bar.progress(progress['processed'] / total_pages)
+                eta = progress['eta']
+                
+                status_text.text(
+                    f"📄 Обработано: {progress['processed']}/{total_pages} | "
+                    f"⚡ Скорость: {progress['recent_speed']:.1f} стр/сек | "
+                    f"⏳ Осталось: {f'~{eta:.0f}с' if eta is not None else '—'} | "
+                    f"✅ Найдено: {stats['direct'] + stats['ocr']} | "
+                    f"❌ Не найдено: {stats['failed']}"
+                )
+            
+            reporter = pdf_engine.ProgressReporter(show_progress, total_pages)
+            
             # Обрабатываем каждую страницу
             for page_num in range(total_pages):
                 if stop_processing.is_set():
@@ -206,21 +217,10 @@ class PDFProcessor:
                     'order_no': order_no
                 })
                 
-                # Прогресс
-                progress = (page_num + 1) / total_pages
-                progress_bar.progress(progress)
-                
-                # Статус
-                elapsed = time.time() - start_time
-                speed = (page_num + 1) / elapsed if elapsed > 0 else 0
-                
-                status_text.text(
-                    f"📄 Обработано: {page_num + 1}/{total_pages} | "
-                    f"⚡ Скорость: {speed:.1f} стр/сек | "
-                    f"✅ Найдено: {stats['direct'] + stats['ocr']} | "
-                    f"❌ Не найдено: {stats['failed']}"
-                )
+                # Прогресс и статус
+                reporter.page(method)
             
+            reporter.close()
             doc.close()
             
             # Создаем ZIP
@@ -244,16 +244,13 @@ class PDFProcessor:
             st.error(f"Детали: {traceback.format_exc()}")
             return None
 
-    def get_download_link(self, file_path, link_text):
-        """Создает ссылку для скачивания"""
-        if not file_path or not os.path.exists(file_path):
-            return "❌ Файл не найден"
-            
-        with open(file_path, "rb") as f:
-            data = f.read()
-        b64 = base64.b64encode(data).decode()
-        href = f'<a href="data:application/zip;base64,{b64}" download="pdf_results.zip" style="background-color: #4CAF50; color: white; padding: 12px 24px; text-decoration: none; border-radius: 8px; display: inline-block; font-weight: bold;">{link_text}</a>'
-        return href
+    def show_download_link(self, file_path, link_text):
+        """Кнопка или ссылка для скачивания файла"""
+        # С настроенным сервером файл отдается с диска кусками, без base64 в памяти
+        download_server.show_download(
+            file_path, link_text,
+            style="background-color: #4CAF50; color: white; padding: 12px 24px; text-decoration: none; border-radius: 8px; display: inline-block; font-weight: bold;"
+        )
 
 def main():
     st.markdown('<div class="main-header">📄 PDF Splitter - RELIABLE</div>', unsafe_allow_html=True)
@@ -318,10 +315,7 @@ def main():
                         if stats.get('zip_path'):
                             st.markdown("---")
                             st.subheader("📥 Скачать результаты")
-                            download_link = st.session_state.processor.get_download_link(
-                                stats['zip_path'], "⬇️ Скачать ZIP архив"
-                            )
-                            st.markdown(download_link, unsafe_allow_html=True)
+                            st.session_state.processor.show_download_link(stats['zip_path'], "⬇️ Скачать ZIP архив")
                         
                         # Список файлов
                         with st.expander("📋 Показать список файлов"):
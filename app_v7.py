@@ -1,16 +1,13 @@
 import streamlit as st
-import fitz
 import pytesseract
-from PIL import Image
-import io
-import re
 import tempfile
 import os
-import zipfile
-import base64
 import time
 import subprocess
 import sys
+import pdf_engine
+import download_server
+import jobs
 
 # Настройка страницы
 st.set_page_config(
@@ -68,18 +65,13 @@ if 'tesseract_checked' not in st.session_state:
 
 tesseract_available = st.session_state.tesseract_available
 
-# Глобальная переменная для остановки
-class StopProcessing:
-    def __init__(self):
-        self._stop = False
-    
-    def set(self):
-        self._stop = True
-    
-    def is_set(self):
-        return self._stop
+# Опрос состояния фонового задания, секунд
+POLL_INTERVAL = 1.0
 
-stop_processing = StopProcessing()
+@st.cache_resource
+def get_job_manager():
+    """Менеджер фоновых заданий, один на процесс для всех сессий"""
+    return jobs.JobManager()
 
 # CSS стили
 st.markdown("""
@@ -102,246 +94,48 @@ class PDFProcessor:
     def __init__(self):
         self.temp_dir = tempfile.mkdtemp()
         
-    def find_order_number_ultra_fast(self, text):
-        """Поиск номера заказа в тексте - ОПТИМИЗИРОВАННЫЙ"""
-        patterns = [
-            r'\b(202[4-9]\d{6})\b',  # 2024XXXXXX
-            r'\b(20\d{8})\b',        # 20XXXXXXXX  
-            r'\b(\d{10})\b',         # Любые 10 цифр
-            r'\b(\d{8,12})\b',       # 8-12 цифр
-            r'\b(ORDER[:\\s]*)(\d{8,12})\b',  # ORDER: 12345678
-            r'\b(№[:\\s]*)(\d{8,12})\b',      # № 12345678
-        ]
-        
-        for pattern in patterns:
-            matches = re.findall(pattern, text, re.IGNORECASE)
-            if matches:
-                # Возвращаем последнюю группу (номер)
-                if isinstance(matches[0], tuple):
-                    for match in matches[0]:
-                        if match and match.isdigit():
-                            return match
-                else:
-                    return matches[0]
-        return None
-
-    def extract_text_optimized(self, page):
-        """Оптимизированное извлечение текста из PDF"""
-        try:
-            # Пробуем разные методы извлечения текста
-            text_methods = []
-            
-            # 1. Быстрый метод
-            text_raw = page.get_text("text")
-            if text_raw and len(text_raw) > 10:
-                text_methods.append(text_raw)
-            
-            # 2. Метод слов (более точный)
-            words = page.get_text("words")
-            if words:
-                text_words = " ".join([word[4] for word in words if len(word) > 4])
-                text_methods.append(text_words)
-            
-            # 3. Метод блоков
-            blocks = page.get_text("blocks")  
-            if blocks:
-                text_blocks = " ".join([block[4] for block in blocks if len(block) > 4])
-                text_methods.append(text_blocks)
-            
-            combined_text = " ".join(text_methods)
-            return combined_text
-            
-        except Exception as e:
-            return ""
-
-    def process_page_fast(self, page_num, page):
-        """Быстрая обработка одной страницы"""
-        if stop_processing.is_set():
-            return None, "stopped", page_num
-        
-        try:
-            # Шаг 1: Быстрое извлечение текста (ОЧЕНЬ БЫСТРО)
-            text_direct = self.extract_text_optimized(page)
-            order_no = self.find_order_number_ultra_fast(text_direct)
-            
-            if order_no:
-                return order_no, "direct", page_num
-            
-            # Шаг 2: OCR если доступен (медленнее, но точнее)
-            if tesseract_available and not order_no:
-                try:
-                    # ОПТИМИЗИРОВАННОЕ создание изображения
-                    pix = page.get_pixmap(matrix=fitz.Matrix(1.2, 1.2))  # Низкое разрешение для скорости
-                    img_data = pix.tobytes("png")  # PNG быстрее
-                    img = Image.open(io.BytesIO(img_data))
-                    
-                    # Минимальная обработка изображения
-                    img = img.convert('L')  # Grayscale
-                    
-                    # ОПТИМИЗИРОВАННЫЙ OCR с быстрыми настройками
-                    ocr_text = pytesseract.image_to_string(
-                        img, 
-                        lang='eng',
-                        config='--oem 1 --psm 6 -c preserve_interword_spaces=0'
-                    )
-                    
-                    order_no = self.find_order_number_ultra_fast(ocr_text)
-                    if order_no:
-                        return order_no, "ocr", page_num
-                        
-                except Exception as e:
-                    return None, "ocr_error", page_num
-            
-            return None, "not_found", page_num
-            
-        except Exception as e:
-            return None, "error", page_num
-
-    def process_pdf_optimized(self, pdf_file, progress_bar, status_text):
-        """ОПТИМИЗИРОВАННАЯ обработка PDF"""
-        global stop_processing
-        stop_processing = StopProcessing()
-        
-        start_time = time.time()
-        
-        # Сохраняем временный файл
-        temp_pdf_path = os.path.join(self.temp_dir, "input.pdf")
-        with open(temp_pdf_path, "wb") as f:
-            f.write(pdf_file.getvalue())
-        
-        try:
-            # Открываем PDF
-            doc = fitz.open(temp_pdf_path)
-            total_pages = len(doc)
-            
-            # Создаем временную папку для результатов
-            output_dir = os.path.join(self.temp_dir, "output")
-            os.makedirs(output_dir, exist_ok=True)
-            
-            # Статистика
-            stats = {
-                'total': total_pages,
-                'direct': 0,
-                'ocr': 0,
-                'failed': 0,
-                'stopped': 0,
-                'files': [],
-                'success_rate': 0,
-                'total_time': 0,
-                'output_dir': output_dir
-            }
-            
-            # Обрабатываем страницы с прогрессом
-            for page_num in range(total_pages):
-                if stop_processing.is_set():
-                    stats['stopped'] = total_pages - page_num
-                    break
-                
-                page_start_time = time.time()
-                
-                page = doc[page_num]
-                order_no, method, _ = self.process_page_fast(page_num, page)
-                
-                # Создаем отдельный PDF
-                new_doc = fitz.open()
-                new_doc.insert_pdf(doc, from_page=page_num, to_page=page_num)
-                
-                # Генерируем имя файла
-                if order_no:
-                    filename = f"{order_no}.pdf"
-                else:
-                    filename = f"page_{page_num + 1}.pdf"
-                
-                output_path = os.path.join(output_dir, filename)
-                
-                # Избегаем перезаписи
-                counter = 1
-                base_name = os.path.splitext(filename)[0]
-                while os.path.exists(output_path):
-                    output_path = os.path.join(output_dir, f"{base_name}_{counter}.pdf")
-                    counter += 1
-                
-                new_doc.save(output_path)
-                new_doc.close()
-                
-                # Обновляем статистику
-                if order_no:
-                    if method == "direct":
-                        stats['direct'] += 1
-                    else:
-                        stats['ocr'] += 1
-                else:
-                    stats['failed'] += 1
-                
-                final_filename = os.path.basename(output_path)
-                stats['files'].append({
-                    'filename': final_filename,
-                    'page': page_num + 1,
-                    'method': method,
-                    'order_no': order_no,
-                    'file_path': output_path,
-                })
-                
-                # Обновляем прогресс
-                progress = (page_num + 1) / total_pages
-                progress_bar.progress(progress)
-                
-                elapsed = time.time() - start_time
-                speed = (page_num + 1) / elapsed if elapsed > 0 else 0
-                processed = page_num + 1
-                
-                status_text.text(
-                    f"📊 Обработано: {processed}/{total_pages} | "
-                    f"⚡ Скорость: {speed:.1f} стр/сек | "
-                    f"✅ Текст: {stats['direct']} | "
-                    f"🔍 OCR: {stats['ocr']} | "
-                    f"❌ Не найдено: {stats['failed']}"
-                )
-            
-            doc.close()
-            
-            # Расчет статистики
-            total_time = time.time() - start_time
-            stats['total_time'] = total_time
-            
-            success_count = stats['direct'] + stats['ocr']
-            stats['success_rate'] = (success_count / stats['total']) * 100 if stats['total'] > 0 else 0
-            
-            return stats
-            
-        except Exception as e:
-            st.error(f"❌ Ошибка обработки PDF: {str(e)}")
-            import traceback
-            st.error(f"Детали: {traceback.format_exc()}")
-            return None
+    def start_processing(self, pdf_file, workers=None, roi=pdf_engine.OCR_ROI):
+        """Запускает обработку PDF фоновым заданием, возвращает номер задания"""
+        # Страницы пишутся в ZIP задания с исходными названиями;
+        # задание живет независимо от перезапусков скрипта и соединения браузера
+        return get_job_manager().submit(
+            pdf_engine.upload_buffer(pdf_file),
+            pdf_file.name,
+            tesseract_available,
+            workers=workers,
+            roi=roi,
+            # Повторная загрузка того же файла берет результаты страниц из кэша
+            cache_path=pdf_engine.RESULT_CACHE_PATH
+        )
 
-    def get_download_link(self, file_path, link_text):
-        """Создает ссылку для скачивания файла"""
-        if not file_path or not os.path.exists(file_path):
-            return "❌ Файл не найден"
-            
-        with open(file_path, "rb") as f:
-            data = f.read()
-        b64 = base64.b64encode(data).decode()
-        href = f'<a href="data:application/zip;base64,{b64}" download="pdf_results.zip" style="background-color: #4CAF50; color: white; padding: 12px 24px; text-decoration: none; border-radius: 8px; display: inline-block; font-weight: bold;">{link_text}</a>'
-        return href
+    def show_download_link(self, file_path, link_text):
+        """Кнопка или ссылка для скачивания файла"""
+        # С настроенным сервером файл отдается с диска кусками, без base64 в памяти
+        download_server.show_download(
+            file_path, link_text,
+            style="background-color: #4CAF50; color: white; padding: 12px 24px; text-decoration: none; border-radius: 8px; display: inline-block; font-weight: bold;"
+        )
 
-    def create_final_zip(self, files_info):
+    def create_final_zip(self, files_info, source_zip):
         """Создает финальный ZIP архив с обновленными названиями"""
         zip_path = os.path.join(self.temp_dir, "final_results.zip")
         
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for file_info in files_info:
-                if os.path.exists(file_info['file_path']):
-                    # Используем новое имя файла если оно было изменено
-                    final_filename = file_info.get('new_filename', file_info['filename'])
-                    zipf.write(file_info['file_path'], final_filename)
+        # Используем новое имя файла если оно было изменено
+        renames = {
+            file_info['filename']: file_info['new_filename']
+            for file_info in files_info
+            if file_info.get('new_filename')
+        }
         
-        return zip_path
+        # Пересобираются только переименованные записи, остальное копируется как есть
+        return pdf_engine.rename_zip_members(source_zip, zip_path, renames)
+
+def stop_current_job():
+    job_id = st.session_state.get('job_id')
+    if job_id and get_job_manager().cancel(job_id):
+        st.warning("Обработка будет остановлена!")
 
 def main():
-    global stop_processing
-    
     # Заголовок приложения
     st.markdown('<div class="main-header">📄 PDF Splitter - Ultra Rapid</div>', unsafe_allow_html=True)
     
@@ -361,11 +155,22 @@ def main():
         else:
             st.warning("⚠️ Tesseract не доступен")
             st.info("Режим: Только текст")
+        
+        workers = st.slider(
+            "⚙️ Процессов обработки",
+            min_value=1,
+            max_value=max(2, pdf_engine.default_workers()),
+            value=pdf_engine.default_workers()
+        )
+        roi_ocr = st.checkbox(
+            "🎯 OCR сначала только по шапке страницы",
+            value=True,
+            help="Область номера уточняется по страницам, где номер найден текстом"
+        )
             
         st.markdown("---")
         if st.button("🛑 Экстренная остановка", use_container_width=True):
-            stop_processing.set()
-            st.warning("Обработка будет остановлена!")
+            stop_current_job()
 
     # Основная область
     col1, col2 = st.columns([2, 1])
@@ -430,18 +235,17 @@ def main():
                                 file_info['new_filename'] = st.session_state.file_edits[i]
                         
                         # Создаем финальный ZIP
-                        final_zip = st.session_state.processor.create_final_zip(st.session_state.processed_files)
+                        final_zip = st.session_state.processor.create_final_zip(
+                            st.session_state.processed_files,
+                            st.session_state.original_zip_path
+                        )
                         st.session_state.final_zip_path = final_zip
                         st.session_state.names_confirmed = True
                         st.success("✅ Названия подтверждены!")
                 
                 with col2:
                     if st.session_state.get('names_confirmed', False):
-                        download_link = st.session_state.processor.get_download_link(
-                            st.session_state.final_zip_path,
-                            "⬇️ Скачать финальные файлы"
-                        )
-                        st.markdown(download_link, unsafe_allow_html=True)
+                        st.session_state.processor.show_download_link(st.session_state.final_zip_path, "⬇️ Скачать финальные файлы")
                 
                 # Кнопка для возврата к исходному ZIP
                 if st.button("⬅️ Вернуться к исходным файлам"):
@@ -459,75 +263,121 @@ def main():
                     stop_clicked = st.button("🛑 Остановить", use_container_width=True)
                 
                 if stop_clicked:
-                    stop_processing.set()
-                    st.warning("Обработка остановлена!")
+                    stop_current_job()
                 
                 if process_clicked:
-                    # Элементы интерфейса
-                    progress_bar = st.progress(0)
-                    status_text = st.empty()
-                    results_placeholder = st.empty()
+                    st.session_state.job_id = st.session_state.processor.start_processing(
+                        uploaded_file, 
+                        workers=workers,
+                        roi=pdf_engine.OCR_ROI if roi_ocr else None
+                    )
+                
+                # Состояние задания берется у менеджера при каждом перезапуске скрипта
+                job_id = st.session_state.get('job_id')
+                job = get_job_manager().get(job_id) if job_id else None
+                if job is not None and job['status'] in jobs.ACTIVE_STATUSES:
+                    stats = job['stats']
+                    st.progress(job['processed'] / job['total'] if job['total'] else 0)
+                    # Скорость и ETA считает ProgressReporter движка
+                    progress = stats.get('progress', {})
+                    eta = progress.get('eta')
+                    st.text(
+                        f"📊 Обработано: {job['processed']}/{job['total']} | "
+                        f"⚡ Скорость: {progress.get('recent_speed', 0):.1f} стр/сек | "
+                        f"⏳ Осталось: {f'~{eta:.0f}с' if eta is not None else '—'} | "
+                        f"✅ Текст: {stats.get('direct', 0)} | "
+                        f"🔍 OCR: {stats.get('ocr', 0)} | "
+                        f"❌ Не найдено: {stats.get('failed', 0)}"
+                    )
+                elif job is not None and job['status'] in ("failed", "interrupted"):
+                    st.error(f"❌ Ошибка обработки PDF: {job['error'] or 'задание прервано перезапуском сервера'}")
+                elif job is not None:
+                    stats = job['stats']
                     
-                    # Обработка PDF
-                    with st.spinner("🔄 Обработка PDF..."):
-                        stats = st.session_state.processor.process_pdf_optimized(
-                            uploaded_file, 
-                            progress_bar, 
-                            status_text
+                    # Сохраняем результаты
+                    st.session_state.processed_files = stats['files']
+                    st.session_state.processing_stats = stats
+                    
+                    # Исходный ZIP собран во время обработки
+                    original_zip = job['zip_path']
+                    st.session_state.original_zip_path = original_zip
+                    
+                    # Детальный отчет
+                    st.markdown("---")
+                    st.subheader("📊 Детальный отчет")
+                    
+                    # Основные метрики
+                    col1, col2, col3, col4 = st.columns(4)
+                    with col1:
+                        st.metric("Всего страниц", stats['total'])
+                    with col2:
+                        st.metric("Найдено текстом", stats['direct'])
+                    with col3:
+                        st.metric("Найдено OCR", stats['ocr'])
+                    with col4:
+                        st.metric("Не найдено", stats['failed'])
+                    
+                    # Дополнительная статистика
+                    col_time, col_rate = st.columns(2)
+                    with col_time:
+                        st.metric("Общее время", f"{stats['total_time']:.1f}с")
+                    with col_rate:
+                        st.metric("Успешность", f"{stats['success_rate']:.1f}%")
+                    
+                    if stats['stopped'] > 0:
+                        st.warning(f"⏹️ Обработка была остановлена! {stats['stopped']} страниц не обработано.")
+                    
+                    if stats.get('cache_hits'):
+                        st.info(f"♻️ Из кэша: {stats['cache_hits']} страниц (без повторного OCR)")
+                    
+                    ocr_skipped = stats.get('ocr_skipped', {})
+                    if ocr_skipped.get('pages'):
+                        saved = ocr_skipped.get('saved_ms')
+                        st.info(
+                            f"📄 Без OCR (полный текстовый слой): {ocr_skipped['pages']} страниц"
+                            + (f", сэкономлено ~{saved / 1000:.1f}с" if saved else "")
                         )
                     
-                    if stats:
-                        # Сохраняем результаты
-                        st.session_state.processed_files = stats['files']
-                        st.session_state.processing_stats = stats
-                        
-                        # Создаем исходный ZIP
-                        original_zip = st.session_state.processor.create_final_zip(stats['files'])
-                        st.session_state.original_zip_path = original_zip
-                        
-                        # Детальный отчет
-                        with results_placeholder.container():
-                            st.markdown("---")
-                            st.subheader("📊 Детальный отчет")
-                            
-                            # Основные метрики
-                            col1, col2, col3, col4 = st.columns(4)
-                            with col1:
-                                st.metric("Всего страниц", stats['total'])
-                            with col2:
-                                st.metric("Найдено текстом", stats['direct'])
-                            with col3:
-                                st.metric("Найдено OCR", stats['ocr'])
-                            with col4:
-                                st.metric("Не найдено", stats['failed'])
-                            
-                            # Дополнительная статистика
-                            col_time, col_rate = st.columns(2)
-                            with col_time:
-                                st.metric("Общее время", f"{stats['total_time']:.1f}с")
-                            with col_rate:
-                                st.metric("Успешность", f"{stats['success_rate']:.1f}%")
-                            
-                            if stats['stopped'] > 0:
-                                st.warning(f"⏹️ Обработка была остановлена! {stats['stopped']} страниц не обработано.")
-                            
-                            # Ссылка для скачивания исходных файлов
-                            st.markdown("---")
-                            st.subheader("📥 Скачать исходные файлы")
-                            download_link = st.session_state.processor.get_download_link(
-                                original_zip,
-                                "⬇️ Скачать ZIP с исходными названиями"
-                            )
-                            st.markdown(download_link, unsafe_allow_html=True)
-                            
-                            # Кнопка для перехода к редактированию
-                            st.markdown("---")
-                            st.subheader("🔍 Проверить названия файлов")
-                            st.info("Рекомендуется проверить названия файлов, особенно тех, что были распознаны через OCR")
-                            
-                            if st.button("📝 Проверить и редактировать названия файлов", type="secondary"):
-                                # Очищаем и перезагружаем страницу для редактирования
-                                st.rerun()
+                    ocr_cache = stats.get('ocr_cache', {})
+                    if ocr_cache.get('hits') or ocr_cache.get('near_hits'):
+                        st.info(
+                            f"🔁 Повторные растры OCR: {ocr_cache['hits'] + ocr_cache['near_hits']} из кэша, "
+                            f"{ocr_cache['misses']} распознано"
+                        )
+                    
+                    # Время извлечения текста по видам
+                    if stats.get('text_views'):
+                        with st.expander("⏱️ Время извлечения текста"):
+                            for view, timing in stats['text_views'].items():
+                                st.write(
+                                    f"`{view}`: {timing['ms']:.0f} мс | "
+                                    f"вызовов: {timing['calls']} | "
+                                    f"совпадений: {timing['hits']}"
+                                )
+                    
+                    # Ступени OCR: где нашелся уверенный номер
+                    if stats.get('ocr_levels'):
+                        with st.expander("🔍 Ступени OCR (область@масштаб)"):
+                            for level, timing in stats['ocr_levels'].items():
+                                st.write(
+                                    f"`{level}`: {timing['ms']:.0f} мс | "
+                                    f"вызовов: {timing['calls']} | "
+                                    f"уверенных номеров: {timing['hits']}"
+                                )
+                    
+                    # Ссылка для скачивания исходных файлов
+                    st.markdown("---")
+                    st.subheader("📥 Скачать исходные файлы")
+                    st.session_state.processor.show_download_link(original_zip, "⬇️ Скачать ZIP с исходными названиями")
+                    
+                    # Кнопка для перехода к редактированию
+                    st.markdown("---")
+                    st.subheader("🔍 Проверить названия файлов")
+                    st.info("Рекомендуется проверить названия файлов, особенно тех, что были распознаны через OCR")
+                    
+                    if st.button("📝 Проверить и редактировать названия файлов", type="secondary"):
+                        # Очищаем и перезагружаем страницу для редактирования
+                        st.rerun()
     
     with col2:
         st.subheader("⚡ Быстрый старт")
@@ -545,6 +395,13 @@ def main():
         - ⏹️ Остановка в любой момент
         - ⚡ Высокая скорость
         """)
+    
+    # Пока задание идет - опрашиваем его, скрипт ничего не обрабатывает сам
+    job_id = st.session_state.get('job_id')
+    job = get_job_manager().get(job_id) if job_id else None
+    if job is not None and job['status'] in jobs.ACTIVE_STATUSES:
+        time.sleep(POLL_INTERVAL)
+        st.rerun()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,446 @@
+"""Замеры производительности движка pdf_engine.
+
+Запуск: python benchmark.py <тест> [файл.pdf] [параметры]
+"""
+import argparse
+import io
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+
+import fitz
+import pytesseract
+from PIL import Image
+
+import pdf_engine
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def _report(title, timings):
+    """Среднее и медиана в мс на страницу"""
+    print(
+        f"{title:<28} среднее {statistics.mean(timings):7.2f} мс | "
+        f"медиана {statistics.median(timings):7.2f} мс"
+    )
+
+
+def bench_render(args):
+    """Растр для OCR: RGB + PNG + convert('L') против прямого серого пиксмапа"""
+    doc = fitz.open(args.pdf)
+    matrix = fitz.Matrix(args.scale, args.scale)
+    pages = range(min(args.pages, len(doc)))
+
+    def legacy(page):
+        pix = page.get_pixmap(matrix=matrix)
+        img = Image.open(io.BytesIO(pix.tobytes("png")))
+        img = img.convert('L')
+        img.load()
+        return img
+
+    def direct(page):
+        pix = page.get_pixmap(matrix=matrix, colorspace=fitz.csGRAY)
+        img = pdf_engine.pixmap_to_image(pix)
+        img.load()
+        return pix, img
+
+    legacy_ms = [_timed(legacy, doc[n])[1] for n in pages]
+    direct_ms = [_timed(direct, doc[n])[1] for n in pages]
+
+    print(f"Страниц: {len(pages)}, масштаб: {args.scale}")
+    _report("PNG + convert('L')", legacy_ms)
+    _report("csGRAY + frombuffer", direct_ms)
+    saved = statistics.mean(legacy_ms) - statistics.mean(direct_ms)
+    print(f"Экономия: {saved:.2f} мс на страницу ({saved / statistics.mean(legacy_ms) * 100:.0f}%)")
+
+
+def _legacy_find_order_number(text):
+    """Прежний поиск: 6 regex, у каждого полный findall"""
+    patterns = [
+        r'\b(202[4-9]\d{6})\b',
+        r'\b(20\d{8})\b',
+        r'\b(\d{10})\b',
+        r'\b(\d{8,12})\b',
+        r'\b(ORDER[:\\s]*)(\d{8,12})\b',
+        r'\b(№[:\\s]*)(\d{8,12})\b',
+    ]
+    for pattern in patterns:
+        matches = re.findall(pattern, text, re.IGNORECASE)
+        if matches:
+            if isinstance(matches[0], tuple):
+                for match in matches[0]:
+                    if match and match.isdigit():
+                        return match
+            else:
+                return matches[0]
+    return None
+
+
+def _synthetic_text(size, rng, with_number=True):
+    """Текст страницы заданного размера: слова, короткие числа и номер в середине"""
+    words = ["Invoice", "Total", "Qty", "Item", "Customer", "Address", "Date", "12.10.2025", "450", "EUR", "7711"]
+    parts = []
+    length = 0
+    while length < size:
+        word = rng.choice(words)
+        parts.append(word)
+        length += len(word) + 1
+    if with_number:
+        parts.insert(len(parts) // 2, f"ORDER: 2025{rng.randrange(10 ** 6):06d}")
+    return " ".join(parts)
+
+
+def bench_match(args):
+    """Поиск номера: прежние 6 regex против одного скомпилированного матчера"""
+    rng = random.Random(42)
+    texts = [_synthetic_text(args.size, rng, not args.missing) for _ in range(args.texts)]
+    matcher = pdf_engine.get_order_matcher(args.patterns)
+
+    legacy_ms = [_timed(_legacy_find_order_number, text)[1] for text in texts]
+    matcher_ms = [_timed(matcher.find, text)[1] for text in texts]
+
+    print(f"Текстов: {len(texts)} по {args.size // 1024} КБ")
+    _report("6 x re.findall", legacy_ms)
+    _report("OrderNumberMatcher", matcher_ms)
+    print(f"Ускорение: {statistics.mean(legacy_ms) / statistics.mean(matcher_ms):.1f}x")
+
+
+def bench_split(args):
+    """Нарезка на файлы: save или tobytes на страницу против split_page_file + SplitWriter"""
+    doc = fitz.open(args.pdf)
+    pages = range(min(args.pages, len(doc)))
+
+    def legacy(output_dir):
+        for n in pages:
+            new_doc = fitz.open()
+            new_doc.insert_pdf(doc, from_page=n, to_page=n)
+            new_doc.save(os.path.join(output_dir, f"page_{n + 1}.pdf"))
+            new_doc.close()
+
+    def via_bytes(output_dir):
+        for n in pages:
+            new_doc = fitz.open()
+            new_doc.insert_pdf(doc, from_page=n, to_page=n)
+            with open(os.path.join(output_dir, f"page_{n + 1}.pdf"), "wb") as f:
+                f.write(new_doc.tobytes())
+            new_doc.close()
+
+    def batched(output_dir):
+        writer = pdf_engine.SplitWriter(output_dir)
+        try:
+            for n in pages:
+                writer.add(f"page_{n + 1}.pdf", pdf_engine.split_page_file(doc, n, writer.scratch_dir))
+        finally:
+            writer.close()
+
+    print(f"Страниц: {len(pages)}")
+    variants = (
+        ("insert_pdf + save", legacy),
+        ("insert_pdf + tobytes", via_bytes),
+        ("split_page_file + SplitWriter", batched),
+    )
+    for title, func in variants:
+        output_dir = tempfile.mkdtemp(prefix="bench_split_")
+        try:
+            _, elapsed = _timed(func, output_dir)
+            sizes = [os.path.getsize(os.path.join(output_dir, name)) for name in os.listdir(output_dir)]
+        finally:
+            shutil.rmtree(output_dir)
+        print(
+            f"{title:<28} {len(pages) / (elapsed / 1000):7.0f} стр/с | "
+            f"средний файл {statistics.mean(sizes) / 1024:6.1f} КБ | всего {sum(sizes) / 1024 / 1024:6.1f} МБ"
+        )
+
+
+def bench_ocr(args):
+    """OCR номера: полный текст (psm 6) против режима номеров (белый список, psm 7 по строкам)
+
+    Эталон - номер из текстового слоя той же страницы (find_order_number_ultra_fast),
+    поэтому корпус - PDF с текстовым слоем; OCR видит только растр.
+    """
+    doc = fitz.open(args.pdf)
+    matcher = pdf_engine.get_order_matcher(args.patterns)
+    learner = pdf_engine.RoiLearner()
+    dpi = int(72 * args.scale)
+
+    samples = []
+    for n in range(min(args.pages, len(doc))):
+        page = doc[n]
+        expected = pdf_engine.find_order_number_ultra_fast(page.get_text(), args.patterns)
+        if not expected:
+            continue
+        clip = None if args.full_page else learner.clip_for(page)
+        samples.append((expected, page.get_pixmap(matrix=fitz.Matrix(args.scale, args.scale), clip=clip,
+                                                  colorspace=fitz.csGRAY)))
+    if not samples:
+        print("Нет страниц с номером в текстовом слое")
+        return
+
+    print(f"Страниц с эталоном: {len(samples)}, масштаб: {args.scale}, {'вся страница' if args.full_page else 'область номера'}")
+    for title, reader in (("psm 6, полный текст", pdf_engine.ocr_pixmap), ("номера, psm 7 по строкам", pdf_engine.ocr_number_lines)):
+        timings = []
+        correct = 0
+        for expected, pix in samples:
+            words, elapsed = _timed(reader, pix, dpi=dpi)
+            timings.append(elapsed)
+            correct += matcher.find(pdf_engine.words_text(words)) == expected
+        _report(title, timings)
+        print(f"{'':<28} точность {correct}/{len(samples)} ({correct / len(samples) * 100:.0f}%)")
+
+
+def _multicolumn_pdf(pages, rng, columns=3, lines=70):
+    """Длинные страницы в несколько колонок, номер заказа в шапке"""
+    doc = fitz.open()
+    words = ["Invoice", "Total", "Qty", "Item", "Customer", "Address", "Date", "12.10.2025", "450", "EUR", "7711"]
+    for _ in range(pages):
+        page = doc.new_page(width=842, height=1191)
+        page.insert_text((40, 40), f"ORDER: 2025{rng.randrange(10 ** 6):06d}", fontsize=12)
+        width = (page.rect.width - 80) / columns
+        for col in range(columns):
+            for line in range(lines):
+                text = " ".join(rng.choice(words) for _ in range(6))
+                page.insert_text((40 + col * width, 80 + line * 15), text, fontsize=8)
+    return doc
+
+
+def bench_text(args):
+    """Текстовый слой: все виды целиком против шапки по блокам (sort=True, top-N, clip)"""
+    if args.pdf:
+        doc = fitz.open(args.pdf)
+    else:
+        doc = _multicolumn_pdf(args.pages, random.Random(42))
+    pages = [doc[n] for n in range(min(args.pages, len(doc)))]
+
+    variants = (
+        ("все виды целиком", {'header_blocks': 0}),
+        (f"шапка, {args.blocks} блоков", {'header_blocks': args.blocks}),
+        (f"шапка, clip {args.clip}", {'header_blocks': args.blocks, 'header_clip': (0.0, 0.0, 1.0, args.clip)}),
+    )
+    expected = None
+    print(f"Страниц: {len(pages)}")
+    for title, options in variants:
+        analyzer = pdf_engine.PageAnalyzer(False, roi=None, **options)
+        results = []
+        timings = []
+        for n, page in enumerate(pages):
+            (order_no, _, _), elapsed = _timed(analyzer.process_page_fast, n, page)
+            results.append(order_no)
+            timings.append(elapsed)
+        _report(title, timings)
+        if expected is None:
+            expected = results
+        else:
+            same = sum(a == b for a, b in zip(results, expected))
+            print(f"{'':<28} совпадает с полным разбором: {same}/{len(pages)}")
+
+
+def _slow_ocr_reader(seconds):
+    """Заглушка OCR: внешний процесс на seconds секунд, как запущенный tesseract"""
+    marker = f"{seconds:.3f}"
+
+    def reader(pix, dpi=72):
+        subprocess.run(["sleep", marker], check=False)
+        return []
+    return reader, marker
+
+
+def _alive(marker):
+    """Сколько процессов-заглушек OCR еще живо"""
+    result = subprocess.run(["pgrep", "-f", f"sleep {marker}"], capture_output=True, text=True)
+    return len(result.stdout.split())
+
+
+def bench_cancel(args):
+    """Задержка остановки: флаг между страницами против CancelToken
+
+    Страницы без текста уходят в OCR, OCR заменен внешним процессом на --ocr-seconds
+    (tesseract в песочнице может не быть). Замер - от просьбы остановиться
+    до возврата split_pdf, и сколько процессов OCR пережило остановку.
+    """
+    doc = fitz.open()
+    for _ in range(args.pages):
+        doc.new_page()
+    source = doc.tobytes()
+    reader, marker = _slow_ocr_reader(args.ocr_seconds)
+    # Воркеры создаются через fork и наследуют заглушку
+    pdf_engine.OCR_READERS['text'] = reader
+
+    print(f"Страниц: {args.pages}, процессов: {args.workers}, OCR страницы: {args.ocr_seconds} с")
+    variants = (
+        ("флаг между страницами", threading.Event, args.workers),
+        ("CancelToken", pdf_engine.CancelToken, args.workers),
+        ("CancelToken, 1 процесс", pdf_engine.CancelToken, 1),
+    )
+    for title, make_stop, workers in variants:
+        latencies = []
+        survivors = []
+        for _ in range(args.runs):
+            stop = make_stop()
+            should_stop = stop if isinstance(stop, pdf_engine.CancelToken) else stop.is_set
+            output_dir = tempfile.mkdtemp(prefix="bench_cancel_")
+            worker = threading.Thread(target=pdf_engine.split_pdf, args=(source, output_dir, True),
+                                      kwargs={'workers': workers, 'should_stop': should_stop, 'roi': None})
+            worker.start()
+            time.sleep(args.after)
+            requested = time.perf_counter()
+            stop.cancel() if isinstance(stop, pdf_engine.CancelToken) else stop.set()
+            worker.join()
+            latencies.append((time.perf_counter() - requested) * 1000)
+            survivors.append(_alive(marker))
+            shutil.rmtree(output_dir)
+            # Пережившие остановку процессы не должны портить следующий замер
+            while _alive(marker):
+                time.sleep(0.1)
+        print(
+            f"{title:<28} остановка: медиана {statistics.median(latencies):7.0f} мс, "
+            f"макс {max(latencies):7.0f} мс | процессов OCR после остановки: {max(survivors)}"
+        )
+
+
+def bench_cancel_thread(args):
+    """Задержка остановки OCR в потоке (app_v4): image_to_string_cancellable убивает tesseract"""
+    marker = f"{args.ocr_seconds:.3f}"
+    tmp_dir = tempfile.mkdtemp(prefix="bench_cancel_")
+    # Заглушка tesseract: принимает любые аргументы и работает --ocr-seconds секунд
+    fake_tesseract = os.path.join(tmp_dir, "tesseract")
+    with open(fake_tesseract, "w") as f:
+        f.write(f"#!/bin/sh\nexec sleep {marker}\n")
+    os.chmod(fake_tesseract, 0o755)
+    pytesseract.pytesseract.tesseract_cmd = fake_tesseract
+    image = Image.new("L", (200, 50), 255)
+
+    latencies = []
+    survivors = []
+    for _ in range(args.runs):
+        stop = threading.Event()
+        worker = threading.Thread(target=pdf_engine.image_to_string_cancellable, args=(image,),
+                                  kwargs={'should_stop': stop.is_set})
+        worker.start()
+        time.sleep(args.after)
+        requested = time.perf_counter()
+        stop.set()
+        worker.join()
+        latencies.append((time.perf_counter() - requested) * 1000)
+        survivors.append(_alive(marker))
+    shutil.rmtree(tmp_dir)
+    print(f"OCR страницы: {args.ocr_seconds} с, остановка через {args.after} с")
+    print(
+        f"{'image_to_string_cancellable':<28} остановка: медиана {statistics.median(latencies):7.0f} мс, "
+        f"макс {max(latencies):7.0f} мс | процессов OCR после остановки: {max(survivors)}"
+    )
+
+
+def bench_workers(args):
+    """Масштабирование split_pdf по числу процессов: скорость и эффективность относительно одного"""
+    counts = args.workers or sorted({1, 2, 4, pdf_engine.default_workers()})
+    use_ocr = args.ocr and pdf_engine.ocr_available()
+    print(f"Ядер: {os.cpu_count()} | OCR: {'да' if use_ocr else 'нет'}")
+    base = None
+    for workers in counts:
+        output_dir = tempfile.mkdtemp(prefix="bench_workers_")
+        try:
+            stats, elapsed = _timed(pdf_engine.split_pdf, args.pdf, output_dir, use_ocr, workers=workers)
+        finally:
+            shutil.rmtree(output_dir)
+        speed = stats['total'] / (elapsed / 1000)
+        base = base or speed
+        print(
+            f"{f'процессов {workers}':<28} {speed:7.1f} стр/с | "
+            f"ускорение {speed / base:5.2f}x | эффективность {speed / base / workers * 100:5.1f}%"
+        )
+
+
+def bench_journal(args):
+    """Цена строки журнала PageJournal на страницу (json + write + flush, без fsync)"""
+    path = os.path.join(tempfile.mkdtemp(prefix="bench_journal_"), "journal.jsonl")
+    journal = pdf_engine.PageJournal(path, args.pages, "", {})
+    timings = []
+    try:
+        for n in range(args.pages):
+            _, elapsed = _timed(journal.record, n, f"2025{n:06d}", "direct", f"2025{n:06d}.pdf", 100.0)
+            timings.append(elapsed)
+    finally:
+        journal.close()
+        shutil.rmtree(os.path.dirname(path))
+    print(f"Страниц: {args.pages}")
+    _report("PageJournal.record", timings)
+    print(f"{'':<28} максимум {max(timings):7.3f} мс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры производительности PDF Splitter")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    render = subparsers.add_parser("render", help="Подготовка растра для OCR")
+    render.add_argument("pdf")
+    render.add_argument("--pages", type=int, default=50)
+    render.add_argument("--scale", type=float, default=pdf_engine.OCR_SCALE)
+    render.set_defaults(func=bench_render)
+
+    match = subparsers.add_parser("match", help="Поиск номера заказа в тексте")
+    match.add_argument("--size", type=int, default=100 * 1024)
+    match.add_argument("--texts", type=int, default=50)
+    match.add_argument("--patterns", default="default")
+    match.add_argument("--missing", action="store_true", help="Тексты без номера")
+    match.set_defaults(func=bench_match)
+
+    split = subparsers.add_parser("split", help="Нарезка на отдельные PDF")
+    split.add_argument("pdf")
+    split.add_argument("--pages", type=int, default=300)
+    split.set_defaults(func=bench_split)
+
+    text = subparsers.add_parser("text", help="Текстовый слой: вся страница против шапки")
+    text.add_argument("pdf", nargs="?", help="Без файла - синтетические страницы в 3 колонки")
+    text.add_argument("--pages", type=int, default=100)
+    text.add_argument("--blocks", type=int, default=8)
+    text.add_argument("--clip", type=float, default=0.2, help="Высота шапки в долях страницы")
+    text.set_defaults(func=bench_text)
+
+    ocr = subparsers.add_parser("ocr", help="OCR номера: полный текст против режима номеров")
+    ocr.add_argument("pdf")
+    ocr.add_argument("--pages", type=int, default=50)
+    ocr.add_argument("--scale", type=float, default=pdf_engine.OCR_LADDER[1])
+    ocr.add_argument("--patterns", default="default")
+    ocr.add_argument("--full-page", action="store_true", help="OCR всей страницы вместо области номера")
+    ocr.set_defaults(func=bench_ocr)
+
+    cancel = subparsers.add_parser("cancel", help="Задержка остановки задания")
+    cancel.add_argument("--pages", type=int, default=200)
+    cancel.add_argument("--workers", type=int, default=4)
+    cancel.add_argument("--ocr-seconds", type=float, default=3.0, help="Длительность OCR одной страницы")
+    cancel.add_argument("--after", type=float, default=1.0, help="Через сколько секунд просить остановку")
+    cancel.add_argument("--runs", type=int, default=3)
+    cancel.set_defaults(func=bench_cancel)
+
+    cancel_thread = subparsers.add_parser("cancel-thread", help="Задержка остановки OCR в потоке (app_v4)")
+    cancel_thread.add_argument("--ocr-seconds", type=float, default=3.0)
+    cancel_thread.add_argument("--after", type=float, default=0.5)
+    cancel_thread.add_argument("--runs", type=int, default=3)
+    cancel_thread.set_defaults(func=bench_cancel_thread)
+
+    workers = subparsers.add_parser("workers", help="Масштабирование по числу процессов")
+    workers.add_argument("pdf")
+    workers.add_argument("--workers", type=int, nargs="+", help="Числа процессов (по умолчанию 1, 2, 4, по ядрам)")
+    workers.add_argument("--ocr", action="store_true", help="С OCR, если он доступен")
+    workers.set_defaults(func=bench_workers)
+
+    journal = subparsers.add_parser("journal", help="Запись журнала продолжения")
+    journal.add_argument("--pages", type=int, default=5000)
+    journal.set_defaults(func=bench_journal)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""Локальная раздача результатов для скачивания
+
+Файл отдается с диска кусками, в память целиком не читается:
+память не зависит от размера архива. Ссылки вида
+http://<хост>:<порт>/<токен>/<имя файла>.
+
+Браузеру такой сервер доступен, только если его порт проброшен наружу,
+поэтому он включается переменными окружения (см. is_configured; в
+.devcontainer порт 8502 задан и проброшен). Без них show_download отдает
+файл кнопкой Streamlit через его собственный адрес: работает за прокси и в
+Streamlit Cloud, но файл целиком в памяти - и читается только по запросу.
+
+Переменные окружения:
+    PDF_DOWNLOAD_HOST - адрес для прослушивания (по умолчанию 127.0.0.1)
+    PDF_DOWNLOAD_PORT - порт (по умолчанию 0 - любой свободный)
+    PDF_DOWNLOAD_URL  - внешний адрес сервера, если он за прокси
+"""
+import http.server
+import mimetypes
+import os
+import secrets
+import shutil
+import threading
+import urllib.parse
+
+CHUNK_SIZE = 1024 * 1024
+# Больше - предупреждение: кнопка Streamlit держит файл целиком в памяти сервера
+BUTTON_SIZE_WARNING = 200 * 1024 * 1024
+
+
+class _DownloadHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        token = urllib.parse.urlsplit(self.path).path.strip('/').split('/')[0]
+        entry = self.server.files.get(token)
+        if entry is None or not os.path.exists(entry[0]):
+            self.send_error(404, "File not found")
+            return
+
+        file_path, filename = entry
+        content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        with open(file_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(size))
+            self.send_header(
+                "Content-Disposition",
+                f"attachment; filename*=UTF-8''{urllib.parse.quote(filename)}"
+            )
+            self.end_headers()
+            try:
+                shutil.copyfileobj(f, self.wfile, CHUNK_SIZE)
+            except (BrokenPipeError, ConnectionResetError):
+                # Пользователь отменил скачивание
+                pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadServer:
+    """HTTP сервер в фоновом потоке, раздает зарегистрированные файлы"""
+
+    def __init__(self, host=None, port=None, public_url=None):
+        host = host or os.environ.get("PDF_DOWNLOAD_HOST", "127.0.0.1")
+        port = int(port if port is not None else os.environ.get("PDF_DOWNLOAD_PORT", 0))
+        self._server = http.server.ThreadingHTTPServer((host, port), _DownloadHandler)
+        self._server.daemon_threads = True
+        self._server.files = {}
+        self._tokens = {}
+
+        if public_url is None:
+            public_url = os.environ.get("PDF_DOWNLOAD_URL")
+        if public_url is None:
+            public_host = "localhost" if host in ("0.0.0.0", "127.0.0.1") else host
+            public_url = f"http://{public_host}:{self._server.server_address[1]}"
+        self.public_url = public_url.rstrip('/')
+
+        self._thread = threading.Thread(target=self._server.serve_forever, name="download-server", daemon=True)
+        self._thread.start()
+
+    def register(self, file_path, filename=None):
+        """Возвращает ссылку на скачивание файла"""
+        entry = (os.path.abspath(file_path), filename or os.path.basename(file_path))
+        # Перезапуски скрипта Streamlit не плодят новые токены
+        token = self._tokens.get(entry)
+        if token is None:
+            token = secrets.token_urlsafe(16)
+            self._tokens[entry] = token
+            self._server.files[token] = entry
+        filename = entry[1]
+        return f"{self.public_url}/{token}/{urllib.parse.quote(filename)}"
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def get_server():
+    """Один сервер на процесс, общий для всех сессий Streamlit"""
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = DownloadServer()
+        return _server
+
+
+def download_link(file_path, link_text, filename="pdf_results.zip", style=""):
+    """HTML ссылка на скачивание файла через локальный сервер"""
+    url = get_server().register(file_path, filename)
+    return f'<a href="{url}" download="{filename}" style="{style}">{link_text}</a>'
+
+
+def is_configured():
+    """Задан внешний адрес или фиксированный порт - сервер доступен браузеру"""
+    return bool(os.environ.get("PDF_DOWNLOAD_URL") or os.environ.get("PDF_DOWNLOAD_PORT"))
+
+
+def show_download(file_path, link_text, filename="pdf_results.zip", style=""):
+    """Скачивание файла в Streamlit: ссылка на локальный сервер или st.download_button"""
+    import streamlit as st
+
+    if not file_path or not os.path.exists(file_path):
+        st.error("❌ Файл не найден")
+        return
+    if is_configured():
+        st.markdown(download_link(file_path, link_text, filename, style), unsafe_allow_html=True)
+        return
+
+    # Файл читается в память только после явного запроса, а не при каждом перезапуске скрипта
+    size = os.path.getsize(file_path)
+    key = f"{os.path.abspath(file_path)}:{os.path.getmtime(file_path)}"
+    prepared = st.session_state.setdefault('download_prepared', set())
+    if key not in prepared:
+        if size > BUTTON_SIZE_WARNING:
+            st.warning(
+                f"⚠️ Файл {size / 1024 / 1024:.0f} МБ будет целиком загружен в память сервера. "
+                "Для больших архивов задайте PDF_DOWNLOAD_PORT (и проброс порта) или PDF_DOWNLOAD_URL"
+            )
+        if not st.button(f"📦 Подготовить: {link_text} ({size / 1024 / 1024:.1f} МБ)", key=f"prepare:{key}"):
+            return
+        prepared.add(key)
+    content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    with open(file_path, "rb") as f:
+        st.download_button(
+            link_text, f, file_name=filename, mime=content_type, type="primary", key=f"download:{key}",
+            # После скачивания файл снова не держится в памяти сессии
+            on_click=prepared.discard, args=(key,)
+        )
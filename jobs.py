@@ -0,0 +1,286 @@
+"""Фоновые задания разделения PDF
+
+Обработка идет в потоках менеджера заданий, а не в потоке скрипта Streamlit:
+перезапуск скрипта и обрыв соединения браузера ее не прерывают,
+интерфейс только опрашивает состояние задания по номеру.
+
+Папка задания:
+    input.pdf  - копия загруженного файла (загрузка живет только в сессии браузера)
+    results.zip - страницы, пишутся по ходу обработки
+    journal.jsonl - готовые страницы (pdf_engine.PageJournal), по нему задание продолжается
+    profile.prof / profile.html - профиль задания, если в опциях profile (pdf_engine.JobProfiler)
+    job.json   - состояние, на диск не чаще раза в STATE_INTERVAL секунд
+
+Переменные окружения:
+    PDF_JOBS_DIR     - папка заданий (по умолчанию ~/.cache/pdf_splitter/jobs)
+    PDF_JOBS_WORKERS - сколько заданий выполняется одновременно (по умолчанию 1)
+    PDF_JOBS_RESUME  - 0: не продолжать прерванные задания при запуске (по умолчанию 1)
+"""
+import concurrent.futures
+import copy
+import json
+import os
+import secrets
+import shutil
+import threading
+import time
+import traceback
+
+import pdf_engine
+
+JOBS_DIR = os.environ.get(
+    "PDF_JOBS_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "pdf_splitter", "jobs")
+)
+STATE_INTERVAL = 1.0
+JOB_TTL = 24 * 3600  # Завершенные задания старше суток удаляются при запуске менеджера
+
+# queued -> running -> done | stopped | failed
+# interrupted - процесс сервера завершился посреди задания
+ACTIVE_STATUSES = ("queued", "running")
+# Из этих состояний задание можно продолжить с места остановки
+RESUMABLE_STATUSES = ("stopped", "failed", "interrupted")
+
+
+class Job:
+    """Состояние одного задания: прогресс, файлы по мере готовности, путь к архиву"""
+
+    def __init__(self, job_id, job_dir, filename, source, options):
+        self.id = job_id
+        self.dir = job_dir
+        self.filename = filename
+        self.source = source
+        self.options = options
+        self.status = "queued"
+        self.processed = 0
+        self.total = 0
+        self.stats = {}
+        self.files = []
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        # Отмена по номеру задания: доходит до процессов-воркеров split_pdf
+        self.cancel_token = pdf_engine.CancelToken()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._saved = 0.0
+
+    @property
+    def zip_path(self):
+        return os.path.join(self.dir, "results.zip")
+
+    @property
+    def state_path(self):
+        return os.path.join(self.dir, "job.json")
+
+    @property
+    def journal_path(self):
+        return os.path.join(self.dir, "journal.jsonl")
+
+    @property
+    def profile_path(self):
+        suffix = ".html" if self.options.get('profile') == "pyinstrument" else ".prof"
+        return os.path.join(self.dir, "profile" + suffix)
+
+    @property
+    def active(self):
+        return self.status in ACTIVE_STATUSES
+
+    def update(self, processed, total_pages, stats, elapsed):
+        """progress_callback для split_pdf"""
+        with self._lock:
+            self.processed = processed
+            self.total = total_pages
+            # Счетчики - маленькие словари; список файлов дополняется только новыми
+            self.stats = {key: copy.deepcopy(value) for key, value in stats.items() if key != 'files'}
+            self.stats['total_time'] = elapsed
+            self.files.extend(stats['files'][len(self.files):])
+        if time.time() - self._saved >= STATE_INTERVAL:
+            self.save()
+
+    def set_status(self, status, stats=None, error=None):
+        with self._lock:
+            self.status = status
+            if status == "running":
+                self.started = time.time()
+                # Продолжение начинает отчет заново, готовые страницы придут из журнала
+                self.processed = 0
+                self.stats = {}
+                self.files = []
+                self.error = None
+            self.finished = None if status in ACTIVE_STATUSES else time.time()
+            if stats is not None:
+                self.stats = {key: value for key, value in stats.items() if key != 'files'}
+                self.files = list(stats['files'])
+                self.total = stats['total']
+                self.processed = self.total - stats['stopped']
+            if error is not None:
+                self.error = error
+        self.save()
+
+    def snapshot(self):
+        """Состояние задания для интерфейса и job.json"""
+        with self._lock:
+            return {
+                'id': self.id,
+                'filename': self.filename,
+                'source': self.source,
+                'options': self.options,
+                'status': self.status,
+                'processed': self.processed,
+                'total': self.total,
+                'stats': dict(self.stats, files=list(self.files)),
+                'zip_path': self.zip_path if self.files else None,
+                'error': self.error,
+                'created': self.created,
+                'started': self.started,
+                'finished': self.finished,
+            }
+
+    def save(self):
+        """Запись job.json через временный файл - читатель не увидит половину"""
+        with self._save_lock:
+            self._saved = time.time()
+            tmp_path = self.state_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.snapshot(), f, ensure_ascii=False, default=str)
+            os.replace(tmp_path, self.state_path)
+
+    @classmethod
+    def load(cls, job_dir):
+        with open(os.path.join(job_dir, "job.json"), encoding="utf-8") as f:
+            state = json.load(f)
+        # JSON превращает кортежи в списки, а от repr опций зависит ключ ResultCache
+        options = {key: tuple(value) if isinstance(value, list) else value
+                   for key, value in state['options'].items()}
+        job = cls(state['id'], job_dir, state['filename'], state['source'], options)
+        stats = state['stats']
+        job.files = stats.pop('files', [])
+        job.stats = stats
+        for key in ('status', 'processed', 'total', 'error', 'created', 'started', 'finished'):
+            setattr(job, key, state[key])
+        return job
+
+
+class JobManager:
+    """Очередь заданий и пул потоков, в которых они выполняются
+
+    Один менеджер на процесс (в Streamlit - через st.cache_resource).
+    Страницы каждого задания по-прежнему обрабатываются пулом процессов split_pdf.
+    """
+
+    def __init__(self, jobs_dir=None, max_jobs=None):
+        self.jobs_dir = jobs_dir or JOBS_DIR
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        max_jobs = max_jobs or int(os.environ.get("PDF_JOBS_WORKERS", 1))
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="pdf-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        """Задания прошлых запусков сервера; прерванные продолжаются с места остановки"""
+        auto_resume = os.environ.get("PDF_JOBS_RESUME", "1") != "0"
+        for name in os.listdir(self.jobs_dir):
+            job_dir = os.path.join(self.jobs_dir, name)
+            try:
+                job = Job.load(job_dir)
+            except (OSError, ValueError, KeyError):
+                continue
+            if time.time() - (job.finished or job.created) > JOB_TTL:
+                shutil.rmtree(job_dir, ignore_errors=True)
+                continue
+            self._jobs[job.id] = job
+            if job.active:
+                # Поток задания умер вместе с прежним процессом
+                job.set_status("interrupted")
+                if auto_resume:
+                    self.resume(job.id)
+
+    def submit(self, source, filename, use_ocr, **options):
+        """Новое задание, возвращает его номер
+
+        source - путь к PDF или буфер с его байтами (upload_buffer()),
+        options - остальные аргументы split_pdf.
+        """
+        # Номер - единственный ключ доступа к заданию в интерфейсе, поэтому неугадываемый
+        job_id = secrets.token_hex(16)
+        job_dir = os.path.join(self.jobs_dir, job_id)
+        os.makedirs(job_dir)
+        if not pdf_engine.is_path(source):
+            # Буфер загрузки пропадет вместе с сессией браузера
+            input_path = os.path.join(job_dir, "input.pdf")
+            pdf_engine.spool_to_file(source, input_path)
+            source = input_path
+        job = Job(job_id, job_dir, filename, os.fspath(source), dict(options, use_ocr=use_ocr))
+        job.save()
+        with self._lock:
+            self._jobs[job_id] = job
+        self._executor.submit(self._run, job)
+        return job_id
+
+    def _run(self, job):
+        if job.cancel_token.is_set():
+            job.set_status("stopped")
+            return
+        job.set_status("running")
+        try:
+            stats = pdf_engine.split_pdf(
+                job.source,
+                pdf_engine.ZipSplitWriter(job.zip_path),
+                progress_callback=job.update,
+                should_stop=job.cancel_token,
+                journal_path=job.journal_path,
+                resume=True,
+                profile_path=job.profile_path,
+                **job.options
+            )
+        except Exception as e:
+            job.set_status("failed", error=f"{type(e).__name__}: {e}\n{traceback.format_exc()}")
+            return
+        job.set_status("stopped" if stats['stopped'] else "done", stats)
+        if job.status == "done" and os.path.dirname(job.source) == job.dir:
+            # Входной файл больше не нужен, архив остается; остановленному он нужен для продолжения
+            os.remove(job.source)
+
+    def get(self, job_id):
+        """Состояние задания (Job.snapshot) или None"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        return job.snapshot() if job is not None else None
+
+    def list_jobs(self):
+        """Состояния заданий, новые первыми"""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return sorted((job.snapshot() for job in jobs), key=lambda state: state['created'], reverse=True)
+
+    def resume(self, job_id):
+        """Продолжение остановленного, упавшего или прерванного задания
+
+        Страницы из журнала не анализируются заново, архив собирается заново.
+        False - задание нельзя продолжить (нет входного файла или оно не остановлено).
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None or job.status not in RESUMABLE_STATUSES or not os.path.exists(job.source):
+            return False
+        job.cancel_token = pdf_engine.CancelToken()
+        job.set_status("queued")
+        self._executor.submit(self._run, job)
+        return True
+
+    def cancel(self, job_id):
+        """Просьба остановить задание; False - задания нет или оно уже завершено"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None or not job.active:
+            return False
+        job.cancel_token.cancel()
+        return True
+
+    def shutdown(self):
+        for job in list(self._jobs.values()):
+            job.cancel_token.cancel()
+        self._executor.shutdown(wait=True)
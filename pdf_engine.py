@@ -0,0 +1,2036 @@
+"""Движок обработки PDF без зависимости от Streamlit.
+
+Функции уровня модуля, чтобы их можно было запускать в дочерних процессах.
+
+Пакетный режим без браузера:
+    python -m pdf_engine split in.pdf [in2.pdf ...] out/ [--workers N] [--zip]
+Прогресс и итог - строки JSON в stdout.
+"""
+try:
+    # Новое имя модуля; import fitz печатает предупреждение в stdout и портит вывод JSON
+    import pymupdf as fitz
+except ImportError:
+    import fitz
+import pytesseract
+from PIL import Image
+import re
+import os
+import time
+import ctypes
+import ctypes.util
+import threading
+import queue
+import mmap
+import zipfile
+import shutil
+import struct
+import copy
+import tempfile
+import multiprocessing
+import concurrent.futures
+import argparse
+import json
+import sys
+import hashlib
+import sqlite3
+import signal
+import math
+import csv
+import io
+import cProfile
+import pstats
+import shlex
+import subprocess
+from collections import namedtuple, OrderedDict
+
+
+# Шаблоны номера заказа: (имя, regex с одной группой - номером), выше в списке - приоритетнее
+DEFAULT_ORDER_PATTERNS = [
+    ('order_prefix', r'\bORDER[:\s]*(\d{8,12})\b'),  # ORDER: 12345678
+    ('number_sign', r'№[:\s]*(\d{8,12})\b'),          # № 12345678
+    ('year_2024', r'\b(202[4-9]\d{6})\b'),            # 2024XXXXXX
+    ('year_20', r'\b(20\d{8})\b'),                    # 20XXXXXXXX
+    ('ten_digits', r'\b(\d{10})\b'),                  # Любые 10 цифр
+    ('eight_twelve', r'\b(\d{8,12})\b'),              # 8-12 цифр
+]
+
+# Кандидат в номер: шаблоны проверяются только в окне вокруг таких мест
+ORDER_NUMBER_ANCHOR = r'\d{8,}'
+
+# Таблица шаблонов заказчика со своим якорем: якорь должен находить каждый номер,
+# который ловят шаблоны, целиком - с его первого символа (короткие и буквенные номера - свой якорь)
+PatternTable = namedtuple('PatternTable', 'patterns anchor')
+
+# Таблицы шаблонов по заказчикам
+PATTERN_TABLES = {
+    'default': PatternTable(DEFAULT_ORDER_PATTERNS, ORDER_NUMBER_ANCHOR),
+}
+
+
+class OrderNumberMatcher:
+    """Один проход по тексту: кандидаты ищутся одним regex, шаблоны проверяются только рядом с ними
+
+    anchor=None - без якоря: каждый шаблон ищется по всему тексту (медленнее, но подходит
+    для любых шаблонов).
+    """
+
+    def __init__(self, patterns=DEFAULT_ORDER_PATTERNS, anchor=ORDER_NUMBER_ANCHOR, window=32):
+        self.names = []
+        self._patterns = []
+        for name, pattern in patterns:
+            compiled = re.compile(pattern, re.IGNORECASE)
+            if compiled.groups != 1:
+                raise ValueError(f"Шаблон '{name}' должен содержать ровно одну группу с номером")
+            self.names.append(name)
+            self._patterns.append(compiled)
+        self._anchor = re.compile(anchor) if anchor is not None else None
+        self.window = window
+
+    def _scan(self, text):
+        """Без якоря: (приоритет, позиция, номер) по всем шаблонам, по одному на позицию"""
+        found = {}
+        for priority, pattern in enumerate(self._patterns):
+            for match in pattern.finditer(text):
+                found.setdefault(match.start(1), (priority, match.group(1)))
+        return sorted((priority, start, number) for start, (priority, number) in found.items())
+
+    def _classify(self, text, start, end):
+        """Самый приоритетный шаблон, у которого номер начинается с кандидата"""
+        # +1 символ справа, чтобы \b на границе видел реальный текст
+        lo, hi = max(0, start - self.window), min(len(text), end + 1)
+        for priority, pattern in enumerate(self._patterns):
+            for match in pattern.finditer(text, lo, hi):
+                if match.start(1) == start:
+                    return priority, match.group(1)
+        return None
+
+    def find_all(self, text):
+        """Кандидаты (приоритет, позиция, номер, имя шаблона)"""
+        if self._anchor is None:
+            return [(priority, start, number, self.names[priority])
+                    for priority, start, number in sorted(self._scan(text or ""), key=lambda c: c[1])]
+        candidates = []
+        for anchor in self._anchor.finditer(text or ""):
+            found = self._classify(text, anchor.start(), anchor.end())
+            if found:
+                priority, number = found
+                candidates.append((priority, anchor.start(), number, self.names[priority]))
+        return candidates
+
+    def find_best(self, text):
+        """Лучший кандидат (приоритет, номер): сначала по приоритету шаблона, затем по позиции"""
+        if not text:
+            return None
+        if self._anchor is None:
+            candidates = self._scan(text)
+            return (candidates[0][0], candidates[0][2]) if candidates else None
+        best = None
+        for anchor in self._anchor.finditer(text):
+            found = self._classify(text, anchor.start(), anchor.end())
+            if found and (best is None or found[0] < best[0]):
+                best = found
+                if best[0] == 0:
+                    break
+        return best
+
+    def find(self, text):
+        """Лучший номер: сначала по приоритету шаблона, затем по позиции"""
+        best = self.find_best(text)
+        return best[1] if best else None
+
+
+_matchers = {}
+
+
+def pattern_table(patterns='default'):
+    """PatternTable по имени таблицы; у своего списка шаблонов якоря нет"""
+    if isinstance(patterns, str):
+        return PATTERN_TABLES[patterns]
+    if isinstance(patterns, PatternTable):
+        return patterns
+    return PatternTable(patterns, None)
+
+
+def get_order_matcher(patterns='default'):
+    """Скомпилированный матчер по имени таблицы, PatternTable или списку шаблонов"""
+    table = pattern_table(patterns)
+    key = (tuple(map(tuple, table.patterns)), table.anchor)
+    if key not in _matchers:
+        _matchers[key] = OrderNumberMatcher(table.patterns, table.anchor)
+    return _matchers[key]
+
+
+def find_order_number_ultra_fast(text, patterns='default'):
+    """Поиск номера заказа в тексте - ОПТИМИЗИРОВАННЫЙ"""
+    return get_order_matcher(patterns).find(text)
+
+
+# Виды текстового слоя в порядке проверки
+TEXT_VIEWS = ("text", "words", "blocks")
+
+# Шапка: первые блоки в порядке чтения проверяются до разбора всей страницы.
+# По умолчанию выключено: без clip выигрыша нет (поиск по виду "text" и так
+# останавливается на первом номере с меткой), с clip быстрее на треть, если
+# номер с меткой в шапке, и медленнее, если нет - см. benchmark.py text
+HEADER_BLOCKS = 0          # Сколько блоков смотреть, 0 - не смотреть шапку
+HEADER_CLIP = None         # Область шапки в долях страницы (x0, y0, x1, y1), None - вся страница
+HEADER_MAX_PRIORITY = 1    # Номер из шапки принимается сразу только для шаблонов с явной меткой (ORDER, №)
+
+
+def _count_time(page_stats, group, name, start, hit=False):
+    """Время (мс), вызовы и попадания этапа в статистике страницы"""
+    if page_stats is None:
+        return
+    entry = page_stats.setdefault(group, {}).setdefault(name, {'ms': 0.0, 'calls': 0, 'hits': 0})
+    entry['ms'] += (time.perf_counter() - start) * 1000
+    entry['calls'] += 1
+    entry['hits'] += int(hit)
+
+
+# Этапы обработки страницы в порядке отчета (stats['stages'])
+STAGES = ("open", "load", "cache", "text", "regex", "classify", "render", "ocr", "split", "write")
+
+
+def _stage_time(page_stats, stage, start):
+    """Время этапа (мс) на странице, вызовы внутри страницы складываются; возвращает текущий момент"""
+    now = time.perf_counter()
+    if page_stats is not None:
+        stages = page_stats.setdefault('stage_ms', {})
+        stages[stage] = stages.get(stage, 0.0) + (now - start) * 1000
+    return now
+
+
+def _text_view(page, textpage, view):
+    """Текст одного вида из уже построенного TextPage"""
+    if view == "text":
+        return page.get_text("text", textpage=textpage)
+    items = page.get_text(view, textpage=textpage)
+    return " ".join([item[4] for item in items if len(item) > 4])
+
+
+# Настройки OCR, одинаковые для C API и pytesseract
+OCR_LANG = 'eng'
+OCR_OEM = 1  # LSTM
+OCR_PSM = 6
+OCR_VARIABLES = {'preserve_interword_spaces': '0'}
+# Для pytesseract, --psm и --dpi добавляются при вызове
+OCR_CONFIG = f'--oem {OCR_OEM} ' + ' '.join(
+    f'-c {name}={value}' for name, value in OCR_VARIABLES.items()
+)
+OCR_SCALE = 1.2  # Разрешение одиночного прохода (benchmark render)
+# Лесенка масштабов OCR: сначала дешевый проход, выше - только без уверенного номера
+OCR_LADDER = (1.0, 1.5, 2.0)
+OCR_MIN_CONFIDENCE = 60  # Уверенность слова с номером (0-100), ниже - повышаем разрешение
+
+# Режим номеров: только цифры и буквы префиксов, без словарей, по строкам
+OCR_PSM_LINE = 7     # Одна строка текста
+OCR_PSM_SPARSE = 11  # Разрозненный текст, если строки не выделились
+NUMBER_OCR_WHITELIST = "0123456789ORDERorder:№"
+# Словари читаются только при инициализации, поэтому отдельно от SetVariable
+NUMBER_OCR_INIT_VARIABLES = {'load_system_dawg': '0', 'load_freq_dawg': '0'}
+NUMBER_OCR_VARIABLES = dict(OCR_VARIABLES, tessedit_char_whitelist=NUMBER_OCR_WHITELIST)
+NUMBER_OCR_CONFIG = f'--oem {OCR_OEM} ' + ' '.join(
+    f'-c {name}={value}' for name, value in {**NUMBER_OCR_INIT_VARIABLES, **NUMBER_OCR_VARIABLES}.items()
+)
+
+
+_libtesseract = None
+_libtesseract_error = None
+
+
+def _load_libtesseract():
+    """Загрузка libtesseract и описание сигнатур C API"""
+    global _libtesseract, _libtesseract_error
+    if _libtesseract is not None or _libtesseract_error is not None:
+        return _libtesseract
+
+    names = ["libtesseract.so.5", "libtesseract.so.4", ctypes.util.find_library("tesseract")]
+    for name in names:
+        if not name:
+            continue
+        try:
+            lib = ctypes.CDLL(name)
+            break
+        except OSError as e:
+            _libtesseract_error = e
+    else:
+        _libtesseract_error = _libtesseract_error or OSError("libtesseract не найдена")
+        return None
+
+    handle = ctypes.c_void_p
+    lib.TessBaseAPICreate.restype = handle
+    lib.TessBaseAPIInit2.argtypes = [handle, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int]
+    lib.TessBaseAPIInit2.restype = ctypes.c_int
+    lib.TessBaseAPIInit4.argtypes = [
+        handle, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int,
+        ctypes.POINTER(ctypes.c_char_p), ctypes.c_int,
+        ctypes.POINTER(ctypes.c_char_p), ctypes.POINTER(ctypes.c_char_p), ctypes.c_size_t, ctypes.c_int
+    ]
+    lib.TessBaseAPIInit4.restype = ctypes.c_int
+    lib.TessBaseAPISetVariable.argtypes = [handle, ctypes.c_char_p, ctypes.c_char_p]
+    lib.TessBaseAPISetVariable.restype = ctypes.c_int
+    lib.TessBaseAPISetPageSegMode.argtypes = [handle, ctypes.c_int]
+    lib.TessBaseAPISetImage.argtypes = [handle, ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int]
+    lib.TessBaseAPISetSourceResolution.argtypes = [handle, ctypes.c_int]
+    lib.TessBaseAPISetRectangle.argtypes = [handle, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int]
+    lib.TessBaseAPIGetUTF8Text.argtypes = [handle]
+    lib.TessBaseAPIGetUTF8Text.restype = ctypes.c_void_p
+    lib.TessBaseAPIMeanTextConf.argtypes = [handle]
+    lib.TessBaseAPIMeanTextConf.restype = ctypes.c_int
+    lib.TessBaseAPIAllWordConfidences.argtypes = [handle]
+    lib.TessBaseAPIAllWordConfidences.restype = ctypes.POINTER(ctypes.c_int)
+    lib.TessDeleteIntArray.argtypes = [ctypes.POINTER(ctypes.c_int)]
+    lib.TessDeleteText.argtypes = [ctypes.c_void_p]
+    lib.TessBaseAPIClear.argtypes = [handle]
+    lib.TessBaseAPIEnd.argtypes = [handle]
+    lib.TessBaseAPIDelete.argtypes = [handle]
+
+    _libtesseract = lib
+    _libtesseract_error = None
+    return lib
+
+
+class TesseractEngine:
+    """Постоянный экземпляр Tesseract: traineddata загружается один раз"""
+
+    def __init__(self, lang=OCR_LANG, oem=OCR_OEM, variables=OCR_VARIABLES, init_variables=None):
+        self._lib = _load_libtesseract()
+        if self._lib is None:
+            raise OSError(f"libtesseract недоступна: {_libtesseract_error}")
+
+        self._api = self._lib.TessBaseAPICreate()
+        datapath = os.environ.get("TESSDATA_PREFIX")
+        datapath = datapath.encode() if datapath else None
+        if init_variables:
+            names = (ctypes.c_char_p * len(init_variables))(*[name.encode() for name in init_variables])
+            values = (ctypes.c_char_p * len(init_variables))(*[value.encode() for value in init_variables.values()])
+            status = self._lib.TessBaseAPIInit4(
+                self._api, datapath, lang.encode(), oem, None, 0, names, values, len(init_variables), 0
+            )
+        else:
+            status = self._lib.TessBaseAPIInit2(self._api, datapath, lang.encode(), oem)
+        if status != 0:
+            self._lib.TessBaseAPIDelete(self._api)
+            self._api = None
+            raise RuntimeError(f"Не удалось инициализировать Tesseract ({lang})")
+
+        for name, value in variables.items():
+            self._lib.TessBaseAPISetVariable(self._api, name.encode(), value.encode())
+        self.last_confidence = None
+
+    def _set_image(self, pix, psm, dpi, rect=None):
+        lib = self._lib
+        lib.TessBaseAPISetPageSegMode(self._api, psm)
+        lib.TessBaseAPISetImage(self._api, pix.samples_ptr, pix.width, pix.height, pix.n, pix.stride)
+        lib.TessBaseAPISetSourceResolution(self._api, dpi)
+        if rect is not None:
+            # Распознается только прямоугольник (x, y, ширина, высота), без копии растра
+            lib.TessBaseAPISetRectangle(self._api, *rect)
+
+    def recognize(self, pix, psm=OCR_PSM, dpi=72):
+        """OCR растра fitz.Pixmap прямо из памяти, без временных файлов"""
+        lib = self._lib
+        self._set_image(pix, psm, dpi)
+
+        text_ptr = lib.TessBaseAPIGetUTF8Text(self._api)
+        self.last_confidence = lib.TessBaseAPIMeanTextConf(self._api)
+        try:
+            return ctypes.string_at(text_ptr).decode("utf-8", "replace") if text_ptr else ""
+        finally:
+            if text_ptr:
+                lib.TessDeleteText(text_ptr)
+            lib.TessBaseAPIClear(self._api)
+
+    def recognize_words(self, pix, psm=OCR_PSM, dpi=72, rect=None):
+        """Слова с уверенностью 0-100, как image_to_data у pytesseract"""
+        lib = self._lib
+        self._set_image(pix, psm, dpi, rect)
+
+        text_ptr = lib.TessBaseAPIGetUTF8Text(self._api)
+        confs_ptr = lib.TessBaseAPIAllWordConfidences(self._api)
+        try:
+            words = ctypes.string_at(text_ptr).decode("utf-8", "replace").split() if text_ptr else []
+            confs = []
+            if confs_ptr:
+                while confs_ptr[len(confs)] != -1:
+                    confs.append(float(confs_ptr[len(confs)]))
+            self.last_confidence = lib.TessBaseAPIMeanTextConf(self._api)
+            # Слова текста и массив уверенностей идут в одном порядке; если нет - берем среднюю
+            if len(confs) != len(words):
+                confs = [float(self.last_confidence)] * len(words)
+            return list(zip(words, confs))
+        finally:
+            if text_ptr:
+                lib.TessDeleteText(text_ptr)
+            if confs_ptr:
+                lib.TessDeleteIntArray(confs_ptr)
+            lib.TessBaseAPIClear(self._api)
+
+    def close(self):
+        if getattr(self, '_api', None) is not None:
+            self._lib.TessBaseAPIEnd(self._api)
+            self._lib.TessBaseAPIDelete(self._api)
+            self._api = None
+
+    def __del__(self):
+        # Потоки Streamlit живут один прогон - освобождаем движок вместе с ними
+        self.close()
+
+
+# Один движок на поток/процесс-воркер
+_ocr_local = threading.local()
+
+
+# Настройки движков по режимам OCR
+OCR_ENGINE_SETTINGS = {
+    'text': {'variables': OCR_VARIABLES},
+    'number': {'variables': NUMBER_OCR_VARIABLES, 'init_variables': NUMBER_OCR_INIT_VARIABLES},
+}
+
+
+def get_tesseract_engine(mode='text'):
+    """Движок Tesseract текущего воркера или None, если C API недоступен"""
+    engines = _ocr_local.__dict__.setdefault('engines', {})
+    if mode not in engines:
+        try:
+            engines[mode] = TesseractEngine(**OCR_ENGINE_SETTINGS[mode])
+        except (OSError, RuntimeError):
+            engines[mode] = None
+    return engines[mode]
+
+
+def pixmap_to_image(pix):
+    """PIL-изображение поверх буфера пиксмапа, без PNG и без копии"""
+    mode = "L" if pix.n == 1 else "RGB"
+    return Image.frombuffer(mode, (pix.width, pix.height), pix.samples_mv, "raw", mode, pix.stride, 1)
+
+
+def ocr_pixmap(pix, dpi=72, mode='text', psm=OCR_PSM, rect=None):
+    """OCR страницы: [(слово, уверенность 0-100)]; постоянный движок, при его отсутствии - pytesseract
+
+    rect - только часть растра (x, y, ширина, высота).
+    """
+    engine = get_tesseract_engine(mode)
+    if engine is not None:
+        return engine.recognize_words(pix, psm=psm, dpi=dpi, rect=rect)
+
+    # Копия: при ошибке pytesseract traceback не держит буфер пиксмапа (BufferError в Pixmap.__del__)
+    img = pixmap_to_image(pix).copy()
+    if rect is not None:
+        x, y, width, height = rect
+        img = img.crop((x, y, x + width, y + height))
+    base_config = NUMBER_OCR_CONFIG if mode == 'number' else OCR_CONFIG
+    data = pytesseract.image_to_data(
+        img, lang=OCR_LANG, config=f'{base_config} --psm {psm} --dpi {dpi}',
+        output_type=pytesseract.Output.DICT
+    )
+    return [(word, float(conf)) for word, conf in zip(data['text'], data['conf']) if word.strip()]
+
+
+def find_text_lines(pix, min_height=6, max_height=60, padding=2):
+    """Строки текста на сером растре по горизонтальной проекции: [(y0, y1)]
+
+    Строка - подряд идущие ряды пикселей темнее фона. Слишком низкие
+    (шум, линейки) и слишком высокие (картинки, слипшиеся блоки) отбрасываются.
+    """
+    img = pixmap_to_image(pix)
+    if img.mode != "L":
+        img = img.convert("L")
+    # Средняя яркость каждого ряда
+    profile = img.resize((1, pix.height), Image.BOX).tobytes()
+    background = sorted(profile)[len(profile) * 3 // 4]
+
+    lines = []
+    start = None
+    for y, value in enumerate(profile + bytes([255])):
+        ink = value < background - 3
+        if ink and start is None:
+            start = y
+        elif not ink and start is not None:
+            if min_height <= y - start <= max_height:
+                lines.append((max(0, start - padding), min(pix.height, y + padding)))
+            start = None
+    return lines
+
+
+def ocr_number_lines(pix, dpi=72):
+    """Режим номеров: белый список символов, psm 7 по строкам-кандидатам,
+    psm 11 по всему растру, если строки не выделились"""
+    lines = find_text_lines(pix)
+    if not lines:
+        return ocr_pixmap(pix, dpi, mode='number', psm=OCR_PSM_SPARSE)
+    words = []
+    for y0, y1 in lines:
+        words.extend(ocr_pixmap(pix, dpi, mode='number', psm=OCR_PSM_LINE, rect=(0, y0, pix.width, y1 - y0)))
+    return words
+
+
+# Распознавание растра по режиму OCR
+OCR_READERS = {
+    'text': ocr_pixmap,
+    'number': ocr_number_lines,
+}
+
+
+def words_text(words):
+    return " ".join(word for word, _ in words)
+
+
+# Полоса шапки, где обычно стоит номер заказа (доли страницы: x0, y0, x1, y1)
+OCR_ROI = (0.0, 0.0, 1.0, 0.25)
+
+
+class RoiLearner:
+    """Область OCR, выученная по страницам документа, решенным текстом"""
+
+    def __init__(self, default_roi=OCR_ROI, margin=0.03, min_samples=3, max_samples=20, max_attempts=40):
+        self.default_roi = default_roi
+        self.margin = margin
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        # Поиск ограничен попытками, а не находками: номер, которого search_for
+        # не видит (разбит на части, другие пробелы), не ищется на каждой странице
+        self.max_attempts = max_attempts
+        self.attempts = 0
+        self.boxes = []
+
+    def observe(self, page, order_no, textpage=None, clip=None):
+        """Запоминаем, где на странице нашелся номер
+
+        textpage - уже построенный TextPage страницы, иначе search_for строит свой
+        (с clip - только для области).
+        """
+        if len(self.boxes) >= self.max_samples or self.attempts >= self.max_attempts:
+            return
+        self.attempts += 1
+        hits = page.search_for(order_no, textpage=textpage, clip=clip)
+        if hits:
+            rect, box = page.rect, hits[0]
+            self.boxes.append((
+                (box.x0 - rect.x0) / rect.width,
+                (box.y0 - rect.y0) / rect.height,
+                (box.x1 - rect.x0) / rect.width,
+                (box.y1 - rect.y0) / rect.height,
+            ))
+
+    def clip_for(self, page):
+        """Прямоугольник OCR для страницы"""
+        if len(self.boxes) >= self.min_samples:
+            x0, y0, x1, y1 = (
+                min(b[0] for b in self.boxes) - self.margin,
+                min(b[1] for b in self.boxes) - self.margin,
+                max(b[2] for b in self.boxes) + self.margin,
+                max(b[3] for b in self.boxes) + self.margin,
+            )
+        else:
+            x0, y0, x1, y1 = self.default_roi
+        rect = page.rect
+        clip = fitz.Rect(
+            rect.x0 + x0 * rect.width,
+            rect.y0 + y0 * rect.height,
+            rect.x0 + x1 * rect.width,
+            rect.y0 + y1 * rect.height,
+        )
+        return clip & rect
+
+
+def dhash(pix, size=8):
+    """Перцептивный хэш (dHash) растра: 64 бита, у похожих картинок близки по Хэммингу"""
+    img = pixmap_to_image(pix)
+    if img.mode != "L":
+        img = img.convert("L")
+    pixels = img.resize((size + 1, size), Image.BILINEAR).tobytes()
+    bits = 0
+    for row in range(size):
+        line = pixels[row * (size + 1):(row + 1) * (size + 1)]
+        for col in range(size):
+            bits = (bits << 1) | (line[col] > line[col + 1])
+    return bits
+
+
+class OcrCache:
+    """Текст OCR по растру: одинаковые страницы распознаются один раз
+
+    Ключ - хэш серых пикселей вместе с размером и DPI. near_distance -
+    допустимое расстояние Хэмминга между dHash для почти одинаковых
+    страниц (титульные листы, повторяющиеся бланки); None - только
+    точные совпадения. Осторожно: бланки, отличающиеся только номером,
+    тоже почти одинаковые.
+    """
+
+    def __init__(self, max_entries=512, near_distance=None):
+        self.max_entries = max_entries
+        self.near_distance = near_distance
+        self._exact = OrderedDict()
+        self._near = OrderedDict()
+
+    def _remember(self, table, key, value):
+        table[key] = value
+        table.move_to_end(key)
+        if len(table) > self.max_entries:
+            table.popitem(last=False)
+
+    def recognize(self, pix, dpi, page_stats=None, mode='text'):
+        """Слова из кэша или OCR с сохранением результата"""
+        digest = hashlib.blake2b(pix.samples_mv, digest_size=16)
+        digest.update(f"{pix.width}x{pix.height}x{pix.n}@{dpi}:{mode}".encode())
+        key = digest.digest()
+
+        entry = self._exact.get(key)
+        if entry is not None:
+            self._exact.move_to_end(key)
+            return self._hit(entry, page_stats, 'hits')
+
+        near_key = None
+        if self.near_distance is not None:
+            near_key = (pix.width, pix.height, (dpi, mode), dhash(pix))
+            for (width, height, level, bits), entry in self._near.items():
+                if (width, height, level) == near_key[:3] and (bits ^ near_key[3]).bit_count() <= self.near_distance:
+                    self._remember(self._exact, key, entry)
+                    return self._hit(entry, page_stats, 'near_hits')
+
+        words = OCR_READERS[mode](pix, dpi=dpi)
+        self._remember(self._exact, key, words)
+        if near_key is not None:
+            self._remember(self._near, near_key, words)
+        if page_stats is not None:
+            counters = page_stats.setdefault('ocr_cache', {})
+            counters['misses'] = counters.get('misses', 0) + 1
+        return words
+
+    @staticmethod
+    def _hit(words, page_stats, kind):
+        if page_stats is not None:
+            counters = page_stats.setdefault('ocr_cache', {})
+            counters[kind] = counters.get(kind, 0) + 1
+        return words
+
+
+def ocr_page(page, clip=None, scale=OCR_SCALE, cache=None, page_stats=None, mode='text'):
+    """Растеризация страницы (или ее части) и OCR: [(слово, уверенность)]
+
+    mode - 'text' (весь текст, psm 6) или 'number' (только номера по строкам).
+    """
+    # Сразу в оттенках серого: без PNG и без конвертации
+    start = time.perf_counter()
+    pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), clip=clip, colorspace=fitz.csGRAY)
+    start = _stage_time(page_stats, 'render', start)
+    dpi = int(72 * scale)
+    try:
+        if cache is not None:
+            return cache.recognize(pix, dpi, page_stats, mode)
+
+        # ОПТИМИЗИРОВАННЫЙ OCR с быстрыми настройками
+        return OCR_READERS[mode](pix, dpi=dpi)
+    finally:
+        _stage_time(page_stats, 'ocr', start)
+
+
+# Классификатор страниц: когда OCR может найти то, чего нет в текстовом слое
+MIN_TEXT_CHARS = 20        # Меньше - текстового слоя по сути нет
+MIN_TEXT_COVERAGE = 0.02   # Доля площади страницы под текстовыми блоками
+MAX_UNMAPPED_RATIO = 0.05  # Доля символов без Unicode (U+FFFD)
+
+
+def classify_page(page, textpage):
+    """Нужен ли OCR странице без номера в тексте: (True/False, причина)"""
+    if page.get_images():
+        return True, "images"
+
+    blocks = page.get_text("blocks", textpage=textpage)
+    text = "".join(block[4] for block in blocks if block[6] == 0)
+    chars = len(text.strip())
+    if chars < MIN_TEXT_CHARS:
+        return True, "no_text"
+    if text.count("\ufffd") / chars > MAX_UNMAPPED_RATIO:
+        return True, "unmapped_glyphs"
+
+    # Шрифты Type3 - картинки глифов, их текст часто не извлекается
+    if any(font[2] == "Type3" for font in page.get_fonts()):
+        return True, "type3_fonts"
+
+    # Текста мало, остальное - векторная графика (например, текст кривыми)
+    area = abs(page.rect)
+    covered = sum(abs(fitz.Rect(block[:4])) for block in blocks if block[6] == 0)
+    if area and covered / area < MIN_TEXT_COVERAGE:
+        return True, "low_coverage"
+
+    return False, "text_layer"
+
+
+# Обрывок номера в тексте OCR: повод повторить на большем разрешении
+OCR_DIGIT_HINT = re.compile(r'\d{4,}')
+
+
+class PageAnalyzer:
+    """Поиск номера заказа на странице с настройками одного задания"""
+
+    def __init__(self, use_ocr, roi=OCR_ROI, patterns='default', ocr_near_distance=None,
+                 ocr_ladder=OCR_LADDER, min_confidence=OCR_MIN_CONFIDENCE, ocr_mode='text',
+                 header_blocks=HEADER_BLOCKS, header_clip=HEADER_CLIP, header_max_priority=HEADER_MAX_PRIORITY):
+        self.use_ocr = use_ocr
+        self.roi_learner = RoiLearner(roi) if roi else None
+        self.matcher = get_order_matcher(patterns)
+        self.ocr_cache = OcrCache(near_distance=ocr_near_distance)
+        self.ocr_ladder = tuple(ocr_ladder)
+        self.min_confidence = min_confidence
+        self.ocr_mode = ocr_mode
+        self.header_blocks = header_blocks
+        self.header_clip = header_clip
+        self.header_max_priority = header_max_priority
+        # Уверенность результата последней страницы (0-100)
+        self.confidence = None
+        # Ключ ResultCache последней страницы, None - страница не искалась в кэше
+        self.cache_key = None
+
+    def header_rect(self, page):
+        """Прямоугольник шапки (header_clip) на странице"""
+        rect = page.rect
+        x0, y0, x1, y1 = self.header_clip
+        return fitz.Rect(
+            rect.x0 + x0 * rect.width, rect.y0 + y0 * rect.height,
+            rect.x0 + x1 * rect.width, rect.y0 + y1 * rect.height,
+        )
+
+    def find_in_header(self, page, page_stats=None, textpage=None):
+        """Номер из первых блоков в порядке чтения, до первого совпадения с явной меткой
+
+        С header_clip текст извлекается только из шапки; при промахе
+        полный TextPage строится отдельно.
+        """
+        if not self.header_blocks:
+            return None
+        start = time.perf_counter()
+        order_no = None
+        try:
+            if self.header_clip is not None:
+                clip = self.header_rect(page)
+                # TextPage с clip оставляет пустые блоки вне области - get_text с clip их отбрасывает
+                blocks = page.get_text("blocks", clip=clip, sort=True)
+            else:
+                blocks = page.get_text("blocks", textpage=textpage or page.get_textpage(), sort=True)
+            stage_start = _stage_time(page_stats, 'text', start)
+
+            blocks = [block for block in blocks if block[6] == 0 and block[4].strip()]
+            for block in blocks[:self.header_blocks]:
+                found = self.matcher.find_best(block[4])
+                if found and found[0] <= self.header_max_priority:
+                    order_no = found[1]
+                    break
+            _stage_time(page_stats, 'regex', stage_start)
+        except Exception as e:
+            order_no = None
+        _count_time(page_stats, 'text_views', 'header', start, hit=bool(order_no))
+        return order_no
+
+    def find_in_text_layer(self, page, page_stats=None, textpage=None):
+        """Номер из текстового слоя: один TextPage, виды по очереди до первого совпадения"""
+        try:
+            if textpage is None:
+                start = time.perf_counter()
+                textpage = page.get_textpage()
+                _count_time(page_stats, 'text_views', 'textpage', start)
+                _stage_time(page_stats, 'text', start)
+
+            for view in TEXT_VIEWS:
+                start = time.perf_counter()
+                text = _text_view(page, textpage, view)
+                regex_start = _stage_time(page_stats, 'text', start)
+                order_no = self.matcher.find(text)
+                _stage_time(page_stats, 'regex', regex_start)
+                _count_time(page_stats, 'text_views', view, start, hit=bool(order_no))
+                if order_no:
+                    return order_no
+            return None
+
+        except Exception as e:
+            return None
+
+    def find_in_words(self, words):
+        """Номер и уверенность слова, в котором он найден"""
+        order_no = self.matcher.find(words_text(words))
+        if not order_no:
+            return None, None
+        confs = [conf for word, conf in words if order_no in word and conf >= 0]
+        return order_no, (min(confs) if confs else None)
+
+    def find_by_ocr(self, page, page_stats=None):
+        """OCR лесенкой: область номера, затем страница; масштаб растет,
+        пока номер не уверенный или в тексте есть похожие на него цифры"""
+        areas = []
+        if self.roi_learner is not None:
+            areas.append(('roi', self.roi_learner.clip_for(page)))
+        areas.append(('page', None))
+
+        best = (None, None)
+        for area, clip in areas:
+            for scale in self.ocr_ladder:
+                start = time.perf_counter()
+                words = ocr_page(page, clip, scale, self.ocr_cache, page_stats, self.ocr_mode)
+                regex_start = time.perf_counter()
+                order_no, confidence = self.find_in_words(words)
+                _stage_time(page_stats, 'regex', regex_start)
+                confident = bool(order_no) and (confidence is None or confidence >= self.min_confidence)
+                _count_time(page_stats, 'ocr_levels', f"{area}@{scale:g}", start, hit=confident)
+                if confident:
+                    return order_no, confidence
+                if order_no and (best[0] is None or confidence > best[1]):
+                    best = (order_no, confidence)
+                # Ни номера, ни длинных цифр - большее разрешение здесь не поможет
+                if not order_no and not OCR_DIGIT_HINT.search(words_text(words)):
+                    break
+        return best
+
+    def lookup_cache(self, page, cache, page_stats=None):
+        """(order_no, method, confidence) из ResultCache или None, ключ - в self.cache_key"""
+        start = time.perf_counter()
+        self.cache_key = cache.key_for(page.parent, page)
+        cached = cache.get(self.cache_key) if self.cache_key else None
+        _stage_time(page_stats, 'cache', start)
+        return cached
+
+    def process_page_fast(self, page_num, page, page_stats=None, cache=None):
+        """Быстрая обработка одной страницы
+
+        cache - ResultCache: в нем ищутся только страницы, которые не решил текстовый слой -
+        отпечаток страницы стоит столько же, сколько извлечение текста, и окупается лишь перед OCR.
+        """
+        self.confidence = None
+        self.cache_key = None
+        try:
+            # Шаг 1: Быстрое извлечение текста (ОЧЕНЬ БЫСТРО)
+            # Шапка с header_clip - свой маленький TextPage, до построения полного
+            order_no = self.find_in_header(page, page_stats) if self.header_clip is not None else None
+            textpage = None
+            if not order_no:
+                start = time.perf_counter()
+                textpage = page.get_textpage()
+                _count_time(page_stats, 'text_views', 'textpage', start)
+                _stage_time(page_stats, 'text', start)
+                if self.header_clip is None:
+                    order_no = self.find_in_header(page, page_stats, textpage)
+                if not order_no:
+                    order_no = self.find_in_text_layer(page, page_stats, textpage)
+
+            if order_no:
+                # Область нужна только OCR. Без TextPage номер нашелся в шапке (header_clip) - там и ищется
+                if self.use_ocr and self.roi_learner is not None:
+                    clip = self.header_rect(page) if textpage is None else None
+                    self.roi_learner.observe(page, order_no, textpage, clip)
+                self.confidence = 100.0
+                return order_no, "direct", page_num
+
+            # Шаг 2: OCR если доступен (медленнее, но точнее)
+            if self.use_ocr and not order_no:
+                cached = self.lookup_cache(page, cache, page_stats) if cache is not None else None
+                if cached:
+                    order_no, method, self.confidence = cached
+                    if page_stats is not None:
+                        page_stats['cache_hits'] = 1
+                    return order_no, method, page_num
+
+                # Полный текстовый слой без картинок: растр не покажет ничего нового
+                start = time.perf_counter()
+                needs_ocr, reason = classify_page(page, textpage)
+                _count_time(page_stats, 'page_classes', reason, start, hit=needs_ocr)
+                _stage_time(page_stats, 'classify', start)
+                if not needs_ocr:
+                    return None, "not_found", page_num
+
+                try:
+                    # Сначала только область номера, всю страницу - если там пусто
+                    order_no, self.confidence = self.find_by_ocr(page, page_stats)
+                    if order_no:
+                        return order_no, "ocr", page_num
+
+                except Exception as e:
+                    return None, "ocr_error", page_num
+
+            return None, "not_found", page_num
+
+        except Exception as e:
+            return None, "error", page_num
+
+
+# Сохранение страниц: сжатие потоков, объектные потоки.
+# Без garbage: insert_pdf и так копирует только нужные странице объекты, сборка мусора лишь тратит время
+SAVE_OPTIONS = {'deflate': True, 'use_objstms': 1}
+
+
+# save() в файл по пути в разы быстрее tobytes(): тот пишет через поток Python
+SCRATCH_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+def split_page_file(doc, page_num, scratch_dir):
+    """Отдельный PDF из одной страницы во временный файл в scratch_dir, возвращает путь
+
+    Байты страницы не читаются обратно и не передаются между процессами:
+    SplitWriter переименовывает файл на место, ZipSplitWriter дописывает его в архив.
+    """
+    page_path = os.path.join(scratch_dir, f"page_{page_num}.pdf")
+    new_doc = fitz.open()
+    try:
+        new_doc.insert_pdf(doc, from_page=page_num, to_page=page_num)
+        new_doc.save(page_path, **SAVE_OPTIONS)
+    finally:
+        new_doc.close()
+    return page_path
+
+
+class SplitWriter:
+    """Запись готовых страниц в папку пачками в фоновом потоке
+
+    Страницы приходят файлами из scratch_dir (split_page_file) - в той же
+    файловой системе, что и папка результатов, запись сводится к переименованию.
+    """
+
+    def __init__(self, output_dir, batch_size=16, max_batches=8, overwrite=False):
+        self.output_dir = output_dir
+        os.makedirs(output_dir, exist_ok=True)
+        # Временные папки запусков, упавших до close()
+        for name in os.listdir(output_dir):
+            if name.startswith(".split_"):
+                shutil.rmtree(os.path.join(output_dir, name), ignore_errors=True)
+        # Файлы прошлых запусков в той же папке тоже занимают имена;
+        # overwrite=True - одноименные файлы заменяются, а не получают _1, _2
+        names = set() if overwrite else set(os.listdir(output_dir))
+        self._start(names, tempfile.mkdtemp(prefix=".split_", dir=output_dir), batch_size, max_batches)
+
+    def _start(self, names, scratch_dir, batch_size, max_batches):
+        self._names = names
+        # Удаляется при close() вместе со страницами, до которых не дошла очередь
+        self.scratch_dir = scratch_dir
+        # Время записи каждого файла, мс (этап write в stats['stages'])
+        self.write_ms = []
+        self.batch_size = batch_size
+        self._batch = []
+        # Ограниченная очередь: обработка не убегает далеко вперед записи
+        self._queue = queue.Queue(maxsize=max_batches)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="split-writer", daemon=True)
+        self._thread.start()
+
+    def unique_name(self, filename):
+        """Имя без перезаписи: name.pdf, name_1.pdf, ..."""
+        base_name, ext = os.path.splitext(filename)
+        counter = 1
+        while filename in self._names:
+            filename = f"{base_name}_{counter}{ext}"
+            counter += 1
+        self._names.add(filename)
+        return filename
+
+    def reserve(self, filename):
+        """Имя уже занято файлом на диске (страница, записанная до сбоя)"""
+        self._names.add(filename)
+
+    def add(self, filename, page_path):
+        """Ставит файл страницы в очередь записи, возвращает итоговое имя"""
+        filename = self.unique_name(filename)
+        self._batch.append((filename, page_path))
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+        return filename
+
+    def _flush(self):
+        if self._batch:
+            self._queue.put(self._batch)
+            self._batch = []
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            # После ошибки только разбираем очередь, чтобы не блокировать обработку
+            if self._error is None:
+                try:
+                    self.write_batch(batch)
+                except Exception as e:
+                    self._error = e
+
+    def write_batch(self, batch):
+        for filename, page_path in batch:
+            start = time.perf_counter()
+            os.replace(page_path, os.path.join(self.output_dir, filename))
+            self.write_ms.append((time.perf_counter() - start) * 1000)
+
+    def has_file(self, filename):
+        """Файл уже на месте (записан до сбоя) - при продолжении задания не пишется заново"""
+        return os.path.exists(os.path.join(self.output_dir, filename))
+
+    def close(self):
+        """Дописывает очередь и ждет фоновый поток"""
+        if self._thread.is_alive():
+            self._flush()
+            self._queue.put(None)
+            self._thread.join()
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+        if self._error is not None:
+            raise self._error
+
+
+class ZipSplitWriter(SplitWriter):
+    """Запись страниц сразу в ZIP, без промежуточных файлов
+
+    PDF уже сжаты внутри, поэтому по умолчанию ZIP_STORED.
+    """
+
+    def __init__(self, zip_path, compression=zipfile.ZIP_STORED, batch_size=16, max_batches=8):
+        self.zip_path = zip_path
+        self._zip = zipfile.ZipFile(zip_path, 'w', compression=compression)
+        # Страницы ждут записи рядом с архивом, а не в /dev/shm: в контейнере там по умолчанию 64 МБ,
+        # а в очереди и у воркеров одновременно сотни страниц.
+        # Префикс по имени архива: соседние архивы могут писаться в ту же папку параллельно
+        scratch_root = os.path.dirname(os.path.abspath(zip_path))
+        prefix = f".{os.path.basename(zip_path)}.split_"
+        for name in os.listdir(scratch_root):
+            if name.startswith(prefix):
+                shutil.rmtree(os.path.join(scratch_root, name), ignore_errors=True)
+        scratch_dir = tempfile.mkdtemp(prefix=prefix, dir=scratch_root)
+        self._start(set(), scratch_dir, batch_size, max_batches)
+
+    def write_batch(self, batch):
+        for filename, page_path in batch:
+            start = time.perf_counter()
+            self._zip.write(page_path, filename)
+            os.remove(page_path)
+            self.write_ms.append((time.perf_counter() - start) * 1000)
+
+    def has_file(self, filename):
+        # Архив после сбоя без оглавления - собирается заново
+        return False
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._zip.close()
+
+
+def rename_zip_members(src_zip, dst_zip, renames):
+    """Копия архива с новыми именами файлов, без пересжатия
+
+    renames - {старое имя: новое}. Архив копируется средствами ОС, данные
+    переименованных файлов дописываются в конец копии как есть, с новым
+    локальным заголовком, и переписывается центральный каталог. Старые
+    записи остаются в файле, но каталог на них больше не ссылается.
+    """
+    shutil.copyfile(src_zip, dst_zip)
+    if not renames:
+        return dst_zip
+
+    with open(src_zip, "rb") as src, zipfile.ZipFile(dst_zip, 'a') as dst:
+        for index, info in enumerate(dst.filelist):
+            new_name = renames.get(info.filename)
+            if not new_name or new_name == info.filename:
+                continue
+
+            # Сжатые данные начинаются сразу после локального заголовка
+            src.seek(info.header_offset)
+            header = src.read(zipfile.sizeFileHeader)
+            name_len, extra_len = struct.unpack("<HH", header[26:30])
+            src.seek(info.header_offset + zipfile.sizeFileHeader + name_len + extra_len)
+
+            new_info = copy.copy(info)
+            new_info.filename = new_name
+            # Размеры и CRC пишутся в заголовок, дескриптор после данных не нужен
+            new_info.flag_bits &= ~0x08
+            new_info.header_offset = dst.fp.tell()
+            dst.fp.write(new_info.FileHeader())
+
+            remaining = info.compress_size
+            while remaining:
+                chunk = src.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    raise zipfile.BadZipFile(f"Обрезанные данные: {info.filename}")
+                dst.fp.write(chunk)
+                remaining -= len(chunk)
+
+            dst.filelist[index] = new_info
+            if dst.NameToInfo.get(info.filename) is info:
+                del dst.NameToInfo[info.filename]
+            dst.NameToInfo[new_name] = new_info
+            dst.start_dir = dst.fp.tell()
+            dst._didModify = True
+
+    return dst_zip
+
+
+def upload_buffer(pdf_file):
+    """Байты загруженного файла без копии (UploadedFile в Streamlit - это BytesIO)"""
+    if hasattr(pdf_file, "getbuffer"):
+        return pdf_file.getbuffer()
+    return pdf_file.getvalue()
+
+
+def is_path(source):
+    return isinstance(source, (str, os.PathLike))
+
+
+def open_pdf(source):
+    """Документ из пути к файлу или прямо из буфера в памяти"""
+    if is_path(source):
+        return fitz.open(source)
+    return fitz.open(stream=memoryview(source), filetype="pdf")
+
+
+def source_digest(source, chunk_size=1 << 20):
+    """Хэш всего содержимого PDF (путь или буфер), blake2b"""
+    digest = hashlib.blake2b(digest_size=20)
+    if is_path(source):
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+    else:
+        digest.update(memoryview(source))
+    return digest.hexdigest()
+
+
+def spool_to_file(source, path, chunk_size=1 << 20):
+    """Запись буфера на диск кусками, без промежуточной копии bytes"""
+    view = memoryview(source)
+    with open(path, "wb") as f:
+        for offset in range(0, len(view), chunk_size):
+            f.write(view[offset:offset + chunk_size])
+
+
+class SharedPDFBuffer:
+    """Входной PDF в памяти один раз, общий для всех воркеров
+
+    Файл отображается в память (mmap), буфер загрузки используется как есть.
+    """
+
+    def __init__(self, source):
+        self._mmap = None
+        if is_path(source):
+            with open(source, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._buffer = self._mmap
+        else:
+            self._buffer = source
+
+    def open_document(self):
+        """Собственный дескриптор документа без копирования байтов"""
+        return fitz.open(stream=memoryview(self._buffer), filetype="pdf")
+
+    def close(self):
+        if self._mmap is None:
+            return
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Документы еще держат буфер - отображение освободится вместе с ними
+            pass
+
+
+# Кэш результатов страниц между запусками
+RESULT_CACHE_PATH = os.environ.get(
+    "PDF_SPLITTER_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "pdf_splitter", "results.sqlite")
+)
+# Версия логики поиска: смена версии делает старые записи недействительными
+RESULT_CACHE_VERSION = 1
+# Кэшируются только окончательные результаты, ошибки - нет
+CACHEABLE_METHODS = ("direct", "ocr", "not_found")
+
+
+def page_fingerprint(doc, page):
+    """Хэш содержимого страницы: потоки содержимого, формы, картинки, шрифты
+
+    Номера xref не входят в хэш, поэтому одна и та же страница
+    в другом документе дает тот же отпечаток.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(repr((tuple(page.rect), page.rotation)).encode())
+    for xref in page.get_contents():
+        digest.update(doc.xref_stream_raw(xref) or b"")
+    for xobject in page.get_xobjects():
+        digest.update(doc.xref_stream_raw(xobject[0]) or b"")
+    for image in page.get_images():
+        digest.update(doc.xref_stream_raw(image[0]) or b"")
+    for font in page.get_fonts():
+        digest.update(repr(font[1:]).encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Номер, метод и уверенность по страницам в SQLite, вытеснение LRU
+
+    Ключ - отпечаток страницы плюс настройки поиска и OCR, поэтому
+    документ с частично теми же страницами обходится без OCR для известных
+    страниц. Повторная загрузка того же файла узнается по хэшу всего
+    документа (get_document) - тогда страницы только нарезаются.
+    """
+
+    def __init__(self, path=RESULT_CACHE_PATH, options=None, max_entries=500_000, max_documents=10_000):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_documents = max_documents
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "key TEXT PRIMARY KEY, order_no TEXT, method TEXT, confidence REAL, last_used REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS pages_last_used ON pages (last_used)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS documents (key TEXT PRIMARY KEY, pages TEXT, last_used REAL)"
+        )
+        self._db.commit()
+        self.config_key = self._config_key(options or {})
+
+    @staticmethod
+    def _config_key(options):
+        table = pattern_table(options.get('patterns', 'default'))
+        config = (
+            RESULT_CACHE_VERSION,
+            bool(options.get('use_ocr')),
+            options.get('roi', OCR_ROI),
+            options.get('ocr_near_distance'),
+            tuple(options.get('ocr_ladder', OCR_LADDER)),
+            options.get('min_confidence', OCR_MIN_CONFIDENCE),
+            options.get('ocr_mode', 'text'),
+            options.get('header_blocks', HEADER_BLOCKS),
+            options.get('header_clip', HEADER_CLIP),
+            options.get('header_max_priority', HEADER_MAX_PRIORITY),
+            tuple(map(tuple, table.patterns)), table.anchor,
+            OCR_LANG, OCR_OEM, OCR_PSM, sorted(OCR_VARIABLES.items()),
+        )
+        return hashlib.blake2b(repr(config).encode(), digest_size=8).hexdigest()
+
+    def key_for(self, doc, page):
+        """Ключ страницы; None - страница не читается (битый поток), такие не кэшируются"""
+        try:
+            return f"{self.config_key}:{page_fingerprint(doc, page)}"
+        except Exception:
+            return None
+
+    def get(self, key):
+        """(order_no, method, confidence) или None"""
+        return self._db.execute(
+            "SELECT order_no, method, confidence FROM pages WHERE key = ?", (key,)
+        ).fetchone()
+
+    def put_many(self, entries):
+        """Запись [(key, order_no, method, confidence)], попадания обновляют время доступа"""
+        now = time.time()
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO pages (key, order_no, method, confidence, last_used) VALUES (?, ?, ?, ?, ?)",
+                [(key, order_no, method, confidence, now) for key, order_no, method, confidence in entries]
+            )
+            excess = self._db.execute("SELECT COUNT(*) FROM pages").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self._db.execute(
+                    "DELETE FROM pages WHERE key IN (SELECT key FROM pages ORDER BY last_used LIMIT ?)",
+                    (excess,)
+                )
+
+    def get_document(self, digest):
+        """[(order_no, method, confidence)] по страницам документа (source_digest) или None"""
+        row = self._db.execute(
+            "SELECT pages FROM documents WHERE key = ?", (f"{self.config_key}:{digest}",)
+        ).fetchone()
+        return [tuple(page) for page in json.loads(row[0])] if row else None
+
+    def put_document(self, digest, pages):
+        """Результаты всех страниц документа, только для завершенного задания"""
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO documents (key, pages, last_used) VALUES (?, ?, ?)",
+                (f"{self.config_key}:{digest}", json.dumps(pages, ensure_ascii=False), time.time())
+            )
+            excess = self._db.execute("SELECT COUNT(*) FROM documents").fetchone()[0] - self.max_documents
+            if excess > 0:
+                self._db.execute(
+                    "DELETE FROM documents WHERE key IN (SELECT key FROM documents ORDER BY last_used LIMIT ?)",
+                    (excess,)
+                )
+
+    def close(self):
+        self._db.close()
+
+
+class PageJournal:
+    """Журнал готовых страниц для продолжения задания после сбоя
+
+    Строка JSON на страницу, дописывается в конец. После каждой строки flush
+    без fsync: запись переживает падение процесса, но не отключение питания.
+    Первая строка - заголовок (число страниц, хэш входа source_digest, ключ настроек):
+    журнал другого файла или с другими настройками не применяется.
+    """
+
+    def __init__(self, path, total_pages, digest, options, resume=False):
+        self.path = path
+        header = {'total': total_pages, 'digest': digest, 'config': ResultCache._config_key(options)}
+        self.done = self._read(header) if resume else {}
+        # Журнал переписывается целиком (недописанная строка после сбоя не остается в середине)
+        # через временный файл: сбой во время перезаписи не теряет прежний журнал
+        lines = [header] + [self.done[page_num] for page_num in sorted(self.done)]
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("".join(json.dumps(line, ensure_ascii=False) + "\n" for line in lines))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def _read(self, header):
+        """{номер страницы: запись} из журнала прошлого запуска"""
+        done = {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                if json.loads(f.readline() or "null") != header:
+                    return done
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Последняя строка, оборванная сбоем
+                        break
+                    done[entry['page_num']] = entry
+        except (OSError, ValueError):
+            pass
+        return done
+
+    def resumed(self, has_file=None):
+        """Готовые страницы в виде, который понимает process_page_range
+
+        has_file(filename) - файл страницы уже записан (SplitWriter.has_file), такие не нарезаются.
+        """
+        return {page_num: (entry['order_no'], entry['method'], entry['confidence'],
+                           bool(has_file and has_file(entry['filename'])))
+                for page_num, entry in self.done.items()}
+
+    def record(self, page_num, order_no, method, filename, confidence):
+        self._file.write(json.dumps({
+            'page_num': page_num, 'order_no': order_no, 'method': method,
+            'filename': filename, 'confidence': confidence
+        }, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+# Результат страницы; page_path - файл страницы (split_page_file),
+# cache_key - None, если страница не искалась в кэше
+PageResult = namedtuple(
+    'PageResult', 'order_no method page_num page_path page_stats confidence cache_key'
+)
+
+
+# Состояние дочернего процесса: каждый воркер открывает входной файл сам
+_worker_doc = None
+_worker_analyzer = None
+_worker_cache = None
+_worker_cancel = None
+_worker_resumed = None
+_worker_scratch_dir = None
+_worker_profile_dir = None
+_worker_profiler = None
+
+
+def _init_worker(source, options, tesseract_cmd, cache_path=None, cancel=None, resumed=None, profile_dir=None,
+                 scratch_dir=SCRATCH_DIR):
+    """Инициализация процесса-воркера"""
+    global _worker_doc, _worker_analyzer, _worker_cache, _worker_cancel, _worker_resumed
+    global _worker_scratch_dir, _worker_profile_dir, _worker_profiler
+    if hasattr(os, "setpgid"):
+        # Своя группа процессов: при отмене завершается вместе с запущенным tesseract
+        os.setpgid(0, 0)
+    _worker_cancel = cancel
+    _worker_resumed = resumed
+    _worker_scratch_dir = scratch_dir
+    if profile_dir:
+        _worker_profile_dir = profile_dir
+        _worker_profiler = cProfile.Profile()
+        _worker_profiler.enable()
+    _worker_doc = open_pdf(source)
+    _worker_analyzer = PageAnalyzer(**options)
+    # Соединение SQLite не переживает fork - у воркера свое
+    _worker_cache = ResultCache(cache_path, options) if cache_path else None
+    if tesseract_cmd:
+        pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+
+
+def process_page_range(doc, start, end, analyzer, cache=None, cancel=None, resumed=None, scratch_dir=SCRATCH_DIR):
+    """Обработка диапазона страниц [start, end), при отмене - только начало диапазона
+
+    Страницы нарезаются в scratch_dir (SplitWriter.scratch_dir).
+    resumed - {номер страницы: (order_no, method, confidence, written)} из PageJournal,
+    такие страницы только нарезаются, а уже записанные (written) - и нет: page_path None.
+    """
+    results = []
+    for page_num in range(start, end):
+        if cancel is not None and cancel.is_set():
+            break
+        page_stats = {}
+        known = resumed.get(page_num) if resumed else None
+        if known and known[3]:
+            order_no, method, confidence, _ = known
+            results.append(PageResult(order_no, method, page_num, None, {'resumed': 1}, confidence, None))
+            continue
+        stage_start = time.perf_counter()
+        page = doc[page_num]
+        _stage_time(page_stats, 'load', stage_start)
+        cache_key = None
+        if known:
+            order_no, method, confidence, _ = known
+            page_stats['resumed'] = 1
+        else:
+            order_no, method, _ = analyzer.process_page_fast(page_num, page, page_stats, cache)
+            confidence, cache_key = analyzer.confidence, analyzer.cache_key
+        stage_start = time.perf_counter()
+        page_path = split_page_file(doc, page_num, scratch_dir)
+        _stage_time(page_stats, 'split', stage_start)
+        results.append(PageResult(order_no, method, page_num, page_path, page_stats, confidence, cache_key))
+    return results
+
+
+def _process_page_range(page_range):
+    """Обработка диапазона страниц в воркере"""
+    start, end = page_range
+    results = process_page_range(
+        _worker_doc, start, end, _worker_analyzer, _worker_cache, _worker_cancel, _worker_resumed,
+        _worker_scratch_dir
+    )
+    if _worker_profiler is not None:
+        # Выход воркера не перехватить (пул убивает или завершает его сам) - профиль после каждого диапазона
+        _worker_profiler.dump_stats(os.path.join(_worker_profile_dir, f"worker_{os.getpid()}.prof"))
+        _worker_profiler.enable()
+    return results
+
+
+def default_workers():
+    """Число процессов по умолчанию - по числу ядер"""
+    return os.cpu_count() or 1
+
+
+def _pool_context():
+    # spawn/forkserver заново выполняют скрипт Streamlit (__main__) в каждом воркере
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("fork" if "fork" in methods else "spawn")
+
+
+class CancelToken:
+    """Отмена задания, видимая из любого потока и из процессов-воркеров
+
+    Передается в split_pdf как should_stop. Создается до запуска пула:
+    воркеры получают его при старте (при fork - наследуют).
+    """
+
+    def __init__(self):
+        self._event = _pool_context().Event()
+
+    def cancel(self):
+        self._event.set()
+
+    def is_set(self):
+        return self._event.is_set()
+
+    __call__ = is_set
+
+
+# Как часто ожидание результата воркера проверяет отмену, секунд
+CANCEL_POLL = 0.05
+
+
+def _kill_workers(executor):
+    """Немедленное завершение процессов пула вместе с их дочерними процессами"""
+    for process in list((executor._processes or {}).values()):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (AttributeError, ProcessLookupError, PermissionError):
+            # Windows или воркер еще не успел создать свою группу
+            process.kill()
+
+
+def iter_page_results(source, total_pages, options, workers=None, chunk_size=None, cache=None, cancel=None,
+                      resumed=None, profile_dir=None, scratch_dir=SCRATCH_DIR):
+    """Результаты страниц (PageResult) строго по порядку
+
+    source - путь к PDF или буфер с его байтами, options - аргументы PageAnalyzer,
+    cache - ResultCache или None, cancel - CancelToken или None,
+    resumed - уже готовые страницы, scratch_dir - куда нарезать страницы (см. process_page_range),
+    profile_dir - папка для профилей cProfile воркеров (см. JobProfiler).
+    После отмены или досрочного закрытия генератора процессы-воркеры
+    убиваются сразу, не дожидаясь страниц, которые они обрабатывают.
+    """
+    workers = workers or default_workers()
+    if chunk_size is None:
+        # Небольшие шарды: ровная загрузка ядер и плавный прогресс
+        chunk_size = max(1, min(16, total_pages // (workers * 4)))
+
+    # Мало страниц - процессы не окупаются. С отменой - всегда пул: только процесс-воркер
+    # можно убить посреди страницы вместе с запущенным tesseract
+    if cancel is None and (workers <= 1 or total_pages <= chunk_size):
+        doc = open_pdf(source)
+        analyzer = PageAnalyzer(**options)
+        try:
+            for page_num in range(total_pages):
+                if cancel is not None and cancel.is_set():
+                    break
+                yield process_page_range(doc, page_num, page_num + 1, analyzer, cache, resumed=resumed,
+                                         scratch_dir=scratch_dir)[0]
+        finally:
+            doc.close()
+        return
+
+    ranges = [(start, min(start + chunk_size, total_pages))
+              for start in range(0, total_pages, chunk_size)]
+    context = _pool_context()
+    spool_path = None
+    if not is_path(source) and context.get_start_method() != "fork":
+        # Буфер наследуется воркерами только при fork, иначе - через файл
+        fd, spool_path = tempfile.mkstemp(suffix=".pdf")
+        os.close(fd)
+        spool_to_file(source, spool_path)
+        source = spool_path
+
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(source, options, pytesseract.pytesseract.tesseract_cmd, cache.path if cache else None, cancel,
+                  resumed, profile_dir, scratch_dir)
+    )
+    finished = False
+    try:
+        # Окно отправленных задач ограничено, чтобы остановка не ждала весь документ
+        pending = []
+        next_range = 0
+        while next_range < len(ranges) or pending:
+            while next_range < len(ranges) and len(pending) < workers * 2:
+                pending.append(executor.submit(_process_page_range, ranges[next_range]))
+                next_range += 1
+            future = pending.pop(0)
+            while True:
+                try:
+                    chunk = future.result(timeout=CANCEL_POLL if cancel is not None else None)
+                    break
+                except concurrent.futures.TimeoutError:
+                    if cancel.is_set():
+                        return
+            for result in chunk:
+                yield result
+            if cancel is not None and cancel.is_set():
+                return
+        finished = True
+    finally:
+        if not finished:
+            # Результаты больше не нужны: OCR в воркерах не должен занимать ядра
+            _kill_workers(executor)
+        # Файл можно удалить только после выхода воркеров (Windows)
+        executor.shutdown(wait=spool_path is not None or not finished, cancel_futures=True)
+        if spool_path:
+            os.remove(spool_path)
+
+
+def merge_page_stats(stats, page_stats):
+    """Суммирование счетчиков страницы в общую статистику"""
+    for key, value in page_stats.items():
+        if isinstance(value, dict):
+            merge_page_stats(stats.setdefault(key, {}), value)
+        else:
+            stats[key] = stats.get(key, 0) + value
+
+
+def _percentile(values, q):
+    """Значение ближайшего ранга из отсортированного списка"""
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+def stage_summary(samples):
+    """{этап: [мс на страницу]} -> {этап: {pages, total_ms, p50, p95, max}} в порядке STAGES"""
+    order = [stage for stage in STAGES if stage in samples] + sorted(set(samples) - set(STAGES))
+    summary = {}
+    for stage in order:
+        values = sorted(samples[stage])
+        if not values:
+            continue
+        summary[stage] = {
+            'pages': len(values),
+            'total_ms': sum(values),
+            'p50': _percentile(values, 0.50),
+            'p95': _percentile(values, 0.95),
+            'max': values[-1],
+        }
+    return summary
+
+
+STAGE_REPORT_FIELDS = ('stage', 'pages', 'total_ms', 'p50', 'p95', 'max')
+
+
+def stage_report_json(stages):
+    return json.dumps(stages, ensure_ascii=False, indent=2)
+
+
+def stage_report_csv(stages):
+    """stats['stages'] одной таблицей, время в мс"""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(STAGE_REPORT_FIELDS)
+    for stage, entry in stages.items():
+        writer.writerow([stage] + [round(entry[field], 3) for field in STAGE_REPORT_FIELDS[1:]])
+    return out.getvalue()
+
+
+def write_stage_report(stages, path):
+    """Отчет по этапам в файл: CSV для .csv, иначе JSON"""
+    text = stage_report_csv(stages) if path.lower().endswith(".csv") else stage_report_json(stages)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write(text)
+
+
+PROFILERS = ("cprofile", "pyinstrument")
+
+
+class JobProfiler:
+    """Профиль одного задания
+
+    cprofile - текущий процесс вместе с процессами-воркерами, в path
+    сводный .prof и рядом path + ".txt" (30 функций по накопленному времени).
+    pyinstrument - только текущий процесс (имеет смысл с workers=1), в path HTML.
+    """
+
+    def __init__(self, tool, path):
+        if tool not in PROFILERS:
+            raise ValueError(f"Неизвестный профилировщик: {tool}")
+        self.tool = tool
+        self.path = path
+        self.worker_dir = None
+        if tool == "pyinstrument":
+            # Необязательная зависимость: pip install pyinstrument
+            import pyinstrument
+            self._profiler = pyinstrument.Profiler()
+            self._profiler.start()
+        else:
+            self.worker_dir = tempfile.mkdtemp(prefix="pdf_profile_")
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def stop(self):
+        """Останавливает профилирование и пишет отчет, возвращает путь к нему"""
+        if self.tool == "pyinstrument":
+            self._profiler.stop()
+            with open(self.path, "w", encoding="utf-8") as f:
+                f.write(self._profiler.output_html())
+            return self.path
+
+        self._profiler.disable()
+        combined = pstats.Stats(self._profiler)
+        for name in sorted(os.listdir(self.worker_dir)):
+            try:
+                combined.add(os.path.join(self.worker_dir, name))
+            except (OSError, EOFError, ValueError, TypeError):
+                # Профиль воркера, убитого при отмене посреди записи
+                pass
+        shutil.rmtree(self.worker_dir, ignore_errors=True)
+        combined.dump_stats(self.path)
+        with open(self.path + ".txt", "w", encoding="utf-8") as f:
+            pstats.Stats(self.path, stream=f).sort_stats("cumulative").print_stats(30)
+        return self.path
+
+
+PROGRESS_INTERVAL = 0.2  # Показ прогресса 5 раз в секунду
+
+
+class ProgressReporter:
+    """Прогресс для интерфейса не чаще раза в interval секунд
+
+    page() вызывается на каждой странице и только увеличивает счетчики;
+    callback(progress) получает снимок (см. snapshot) по таймеру,
+    на последней странице и при close().
+    """
+
+    def __init__(self, callback, total, interval=PROGRESS_INTERVAL, start_time=None):
+        self.callback = callback
+        self.total = total
+        self.interval = interval
+        self.processed = 0
+        self.counts = {}
+        self.start_time = start_time or time.time()
+        self._last_time = self.start_time
+        self._last_processed = 0
+        self._reported = 0
+        self._recent_speed = 0.0
+
+    def page(self, stage=None):
+        """Еще одна готовая страница; stage - этап, на котором она решилась (direct, ocr, ...)"""
+        self.processed += 1
+        if stage is not None:
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+        if self.processed >= self.total or time.time() - self._last_time >= self.interval:
+            self.flush()
+
+    def snapshot(self):
+        """processed, total, elapsed, speed (в среднем), recent_speed (за последние интервалы),
+        eta в секундах, counts - страниц по этапам и rates - страниц в секунду по этапам"""
+        elapsed = time.time() - self.start_time
+        speed = self.processed / elapsed if elapsed > 0 else 0
+        recent_speed = self._recent_speed or speed
+        remaining = self.total - self.processed
+        return {
+            'processed': self.processed,
+            'total': self.total,
+            'elapsed': elapsed,
+            'speed': speed,
+            'recent_speed': recent_speed,
+            'eta': remaining / recent_speed if recent_speed > 0 else None,
+            'counts': dict(self.counts),
+            'rates': {stage: count / elapsed if elapsed > 0 else 0 for stage, count in self.counts.items()},
+        }
+
+    def flush(self):
+        now = time.time()
+        window = now - self._last_time
+        if window > 0 and self.processed > self._last_processed:
+            # Сглаженная скорость: ETA не скачет от страницы к странице
+            speed = (self.processed - self._last_processed) / window
+            self._recent_speed = speed if not self._recent_speed else 0.5 * self._recent_speed + 0.5 * speed
+        self._last_time = now
+        self._last_processed = self.processed
+        self._reported = self.processed
+        self.callback(self.snapshot())
+
+    def close(self):
+        """Показывает последние страницы, если они еще не показаны"""
+        if self.processed != self._reported:
+            self.flush()
+
+
+def split_pdf(source, output, use_ocr, workers=None, progress_callback=None, should_stop=None,
+              roi=OCR_ROI, patterns='default', cache_path=None, ocr_near_distance=None,
+              ocr_ladder=OCR_LADDER, ocr_mode='text', header_blocks=HEADER_BLOCKS, header_clip=HEADER_CLIP,
+              journal_path=None, resume=False, progress_interval=PROGRESS_INTERVAL, profile=None, profile_path=None):
+    """Разделение PDF по страницам с поиском номеров заказов
+
+    source - путь к PDF или буфер с его байтами (например, upload_buffer()).
+    progress_callback(processed, total, stats, elapsed) - не чаще раза в progress_interval
+    секунд (ProgressReporter), скорость, ETA и скорость по этапам в stats['progress'].
+    output - папка для файлов или SplitWriter (например, ZipSplitWriter);
+    writer закрывается по окончании, архив к возврату уже готов.
+    should_stop - функция без аргументов, проверяется между страницами, или CancelToken:
+    отмена доходит до воркеров и прерывает страницы, которые они уже обрабатывают.
+    roi - начальная область OCR в долях страницы, None - OCR всей страницы.
+    patterns - имя таблицы из PATTERN_TABLES, PatternTable или свой список шаблонов (без якоря -
+    каждый шаблон ищется по всему тексту).
+    cache_path - файл ResultCache (например, RESULT_CACHE_PATH), None - без кэша.
+    ocr_near_distance - порог dHash для почти одинаковых растров в OcrCache.
+    ocr_ladder - масштабы OCR по возрастанию, статистика по ступеням в stats['ocr_levels'].
+    ocr_mode - 'text' (полное распознавание) или 'number' (цифры по строкам, см. benchmark.py ocr).
+    header_blocks, header_clip - шапка страницы, проверяемая до всего текста (см. PageAnalyzer.find_in_header).
+    journal_path - файл PageJournal, каждая готовая страница отмечается в нем;
+    resume=True - страницы из журнала прошлого запуска не анализируются заново (stats['resumed']).
+    Страницы с полным текстовым слоем без картинок не идут в OCR: решения
+    classify_page в stats['page_classes'], пропуски и оценка экономии в stats['ocr_skipped'].
+    Время по этапам (STAGES) на страницу - p50/p95/max в stats['stages'], см. write_stage_report.
+    profile - 'cprofile' или 'pyinstrument' (JobProfiler), отчет в profile_path
+    (по умолчанию во временной папке), путь к нему в stats['profile'].
+    """
+    start_time = time.time()
+    stage_samples = {}
+    profiler = None
+    writer = cache = journal = None
+
+    try:
+        # До открытия журнала и кэша: без pyinstrument задание падает, ничего не тронув
+        if profile:
+            if profile_path is None:
+                suffix = ".html" if profile == "pyinstrument" else ".prof"
+                profile_path = os.path.join(tempfile.gettempdir(), f"pdf_profile_{os.getpid()}_{int(start_time)}{suffix}")
+            profiler = JobProfiler(profile, profile_path)
+        open_start = time.perf_counter()
+        doc = open_pdf(source)
+        stage_samples['open'] = [(time.perf_counter() - open_start) * 1000]
+        total_pages = len(doc)
+        doc.close()
+
+        # Статистика
+        stats = {
+            'total': total_pages,
+            'direct': 0,
+            'ocr': 0,
+            'failed': 0,
+            'stopped': 0,
+            'files': [],
+            'success_rate': 0,
+            'total_time': 0,
+            'cache_hits': 0,
+            'ocr_cache': {'hits': 0, 'near_hits': 0, 'misses': 0},
+            'text_views': {},
+            'ocr_levels': {},
+            'page_classes': {},
+            'ocr_skipped': {'pages': 0, 'saved_ms': None},
+            'resumed': 0
+        }
+
+        options = {
+            'use_ocr': use_ocr, 'roi': roi, 'patterns': patterns,
+            'ocr_near_distance': ocr_near_distance, 'ocr_ladder': ocr_ladder, 'ocr_mode': ocr_mode,
+            'header_blocks': header_blocks, 'header_clip': header_clip
+        }
+        writer = output if isinstance(output, SplitWriter) else SplitWriter(output)
+        cache = ResultCache(cache_path, options) if cache_path else None
+        cache_entries = []
+        # Хэш входа: ключ журнала и кэша документов, считается один раз
+        document_digest = source_digest(source) if journal_path or cache is not None else None
+        if journal_path:
+            journal = PageJournal(journal_path, total_pages, document_digest, options, resume)
+        cancel = should_stop if isinstance(should_stop, CancelToken) else None
+        reporter = None
+        if progress_callback:
+            def report(progress):
+                stats['progress'] = progress
+                progress_callback(progress['processed'], total_pages, stats, progress['elapsed'])
+            reporter = ProgressReporter(report, total_pages, progress_interval, start_time)
+        resumed = journal.resumed(writer.has_file) if journal else {}
+        for page_num, (*_, written) in resumed.items():
+            if written:
+                # С overwrite имена папки не учитываются, но эти файлы остаются на месте
+                writer.reserve(journal.done[page_num]['filename'])
+        document_hits = set()
+        if cache is not None:
+            # Тот же файл целиком: страницы берутся из кэша без отпечатков и текста, только нарезаются
+            document_pages = cache.get_document(document_digest)
+            if document_pages and len(document_pages) == total_pages:
+                for page_num, page in enumerate(document_pages):
+                    if page_num not in resumed:
+                        resumed[page_num] = (*page, False)
+                        document_hits.add(page_num)
+        results = iter_page_results(source, total_pages, options, workers, cache=cache, cancel=cancel,
+                                    resumed=resumed,
+                                    profile_dir=profiler.worker_dir if profiler else None,
+                                    scratch_dir=writer.scratch_dir)
+    except Exception:
+        # Ошибка подготовки (PDF, кэш, журнал): переданный writer иначе остался бы
+        # с открытым архивом и живым потоком
+        if journal is not None:
+            journal.close()
+        if cache is not None:
+            cache.close()
+        if writer is None and isinstance(output, SplitWriter):
+            writer = output
+        if writer is not None:
+            writer.close()
+        if profiler is not None:
+            profiler.stop()
+        raise
+    try:
+        for result in results:
+            order_no, method, page_num = result.order_no, result.method, result.page_num
+            if should_stop and should_stop():
+                break
+
+            # Генерируем имя файла
+            if order_no:
+                filename = f"{order_no}.pdf"
+            else:
+                filename = f"page_{page_num + 1}.pdf"
+
+            entry = journal.done.get(page_num) if journal else None
+            if entry and (result.page_path is None or writer.has_file(entry['filename'])):
+                filename = entry['filename']
+            else:
+                # Запись идет в фоне, имя уже уникальное
+                filename = writer.add(filename, result.page_path)
+            if journal and (entry is None or entry['filename'] != filename):
+                journal.record(page_num, order_no, method, filename, result.confidence)
+            if result.cache_key and method in CACHEABLE_METHODS:
+                cache_entries.append((result.cache_key, order_no, method, result.confidence))
+            if page_num in document_hits:
+                del result.page_stats['resumed']
+                result.page_stats['cache_hits'] = 1
+
+            # Обновляем статистику
+            if order_no:
+                stage = "direct" if method == "direct" else "ocr"
+            else:
+                stage = "failed"
+            stats[stage] += 1
+
+            stats['files'].append({
+                'filename': filename,
+                'page': page_num + 1,
+                'method': method,
+                'order_no': order_no,
+                'confidence': result.confidence
+            })
+            for stage_name, ms in result.page_stats.pop('stage_ms', {}).items():
+                stage_samples.setdefault(stage_name, []).append(ms)
+            merge_page_stats(stats, result.page_stats)
+
+            if reporter:
+                reporter.page(stage)
+        if reporter:
+            reporter.close()
+    finally:
+        results.close()
+        writer.close()
+        if journal:
+            journal.close()
+        if cache is not None:
+            # Одна транзакция на задание, вместе с попаданиями (обновление LRU)
+            cache.put_many(cache_entries)
+            if len(stats['files']) == total_pages and all(f['method'] in CACHEABLE_METHODS for f in stats['files']):
+                cache.put_document(document_digest, [
+                    (f['order_no'], f['method'], f['confidence']) for f in stats['files']
+                ])
+            cache.close()
+        if profiler is not None:
+            stats['profile'] = profiler.stop()
+
+    # Расчет статистики
+    stats['total_time'] = time.time() - start_time
+    stage_samples['write'] = writer.write_ms
+    stats['stages'] = stage_summary(stage_samples)
+    # Страницы идут по порядку: все после последней записанной не обработаны
+    stats['stopped'] = total_pages - len(stats['files'])
+
+    # Сэкономленное время: пропущенные страницы по среднему времени OCR в этом задании
+    skipped = stats['page_classes'].get('text_layer', {}).get('calls', 0)
+    ocr_pages = sum(entry['hits'] for entry in stats['page_classes'].values())
+    ocr_ms = sum(entry['ms'] for entry in stats['ocr_levels'].values())
+    stats['ocr_skipped'] = {
+        'pages': skipped,
+        'saved_ms': skipped * ocr_ms / ocr_pages if skipped and ocr_pages else None
+    }
+
+    success_count = stats['direct'] + stats['ocr']
+    stats['success_rate'] = (success_count / stats['total']) * 100 if stats['total'] > 0 else 0
+
+    return stats
+
+
+def image_to_string_cancellable(image, lang=OCR_LANG, config='', should_stop=None, timeout=None):
+    """pytesseract.image_to_string для потоков: процесс tesseract убивается по should_stop()
+
+    Проверка каждые CANCEL_POLL секунд; None - остановлено или истек timeout.
+    """
+    with tempfile.TemporaryDirectory(prefix="pdf_ocr_") as tmp_dir:
+        input_path = os.path.join(tmp_dir, "input.png")
+        image.save(input_path)
+        command = [pytesseract.pytesseract.tesseract_cmd, input_path, "stdout", "-l", lang, *shlex.split(config)]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            try:
+                output, _ = process.communicate(timeout=CANCEL_POLL)
+                break
+            except subprocess.TimeoutExpired:
+                if (should_stop is not None and should_stop()) or (deadline and time.monotonic() > deadline):
+                    process.kill()
+                    process.communicate()
+                    return None
+    return output.decode("utf-8", "replace")
+
+
+def ocr_available():
+    """Есть ли чем распознавать: libtesseract или программа tesseract"""
+    if _load_libtesseract() is not None:
+        return True
+    return shutil.which(pytesseract.pytesseract.tesseract_cmd) is not None
+
+
+def _emit(event, **fields):
+    """Одна строка JSON в stdout - для ночных заданий и скриптов"""
+    print(json.dumps(dict(event=event, **fields), ensure_ascii=False, default=str), flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m pdf_engine", description="PDF Splitter без Streamlit")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    split = subparsers.add_parser("split", help="Разделить PDF по страницам с поиском номеров заказов")
+    split.add_argument("inputs", nargs="+", metavar="in.pdf")
+    split.add_argument("output", metavar="out/", help="Папка результатов; для нескольких файлов - подпапки по именам")
+    split.add_argument("--workers", type=int, default=None, help="Процессов (по умолчанию - по числу ядер)")
+    split.add_argument("--zip", action="store_true", help="Писать страницы сразу в <имя>.zip")
+    split.add_argument("--no-ocr", action="store_true", help="Только текстовый слой")
+    split.add_argument("--no-roi", action="store_true", help="OCR сразу всей страницы")
+    split.add_argument("--ocr-mode", default="text", choices=sorted(OCR_READERS),
+                       help="text - весь текст (psm 6), number - только цифры по строкам (сравнение: benchmark.py ocr)")
+    split.add_argument("--patterns", default="default", choices=sorted(PATTERN_TABLES))
+    split.add_argument("--cache", default=RESULT_CACHE_PATH, help="Файл кэша результатов страниц")
+    split.add_argument("--no-cache", action="store_true")
+    split.add_argument("--resume", action="store_true",
+                       help="Продолжить прерванный запуск: страницы из журнала не анализируются заново")
+    split.add_argument("--overwrite", action="store_true",
+                       help="Писать в непустую папку, заменяя одноименные файлы (без него такая папка - ошибка)")
+    split.add_argument("--report", choices=("json", "csv"),
+                       help="Время по этапам (p50/p95/max) в out/<имя>.stages.json|csv")
+    split.add_argument("--profile", choices=PROFILERS,
+                       help="Профиль задания в out/<имя>.prof (cprofile) или out/<имя>.html (pyinstrument)")
+    args = parser.parse_args(argv)
+
+    use_ocr = not args.no_ocr and ocr_available()
+    failed = 0
+    for source in args.inputs:
+        name = os.path.splitext(os.path.basename(source))[0]
+        output = args.output if len(args.inputs) == 1 else os.path.join(args.output, name)
+        if args.zip:
+            os.makedirs(args.output, exist_ok=True)
+            output = ZipSplitWriter(os.path.join(args.output, f"{name}.zip"))
+            journal_path = output.zip_path + ".journal.jsonl"
+        else:
+            os.makedirs(output, exist_ok=True)
+            journal_path = os.path.join(output, ".journal.jsonl")
+            resuming = args.resume and os.path.exists(journal_path)
+            if not resuming and not args.overwrite and any(
+                not entry.startswith(".") for entry in os.listdir(output)
+            ):
+                # Иначе каждый повторный запуск добавлял бы копии name_1.pdf, name_2.pdf, ...
+                failed += 1
+                _emit("error", file=source,
+                      error=f"Папка {output} не пуста и продолжать нечего: нужен --overwrite")
+                continue
+            output = SplitWriter(output, overwrite=args.overwrite)
+
+        def progress(processed, total_pages, stats, elapsed):
+            eta = stats['progress']['eta']
+            _emit("progress", file=source, processed=processed, total=total_pages,
+                  elapsed=round(elapsed, 3), direct=stats['direct'], ocr=stats['ocr'], failed=stats['failed'],
+                  speed=round(stats['progress']['recent_speed'], 1), eta=None if eta is None else round(eta, 1))
+
+        profile_path = None
+        if args.profile:
+            suffix = ".html" if args.profile == "pyinstrument" else ".prof"
+            profile_path = os.path.join(args.output, name + suffix)
+
+        _emit("start", file=source, output=getattr(output, 'zip_path', None) or output.output_dir, ocr=use_ocr)
+        try:
+            stats = split_pdf(
+                source, output, use_ocr,
+                workers=args.workers,
+                progress_callback=progress,
+                roi=None if args.no_roi else OCR_ROI,
+                ocr_mode=args.ocr_mode,
+                patterns=args.patterns,
+                cache_path=None if args.no_cache else args.cache,
+                journal_path=journal_path,
+                resume=args.resume,
+                profile=args.profile,
+                profile_path=profile_path
+            )
+        except Exception as e:
+            failed += 1
+            _emit("error", file=source, error=f"{type(e).__name__}: {e}")
+            if args.zip and os.path.exists(output.zip_path):
+                os.remove(output.zip_path)
+            continue
+        # Журнал нужен только для продолжения
+        os.remove(journal_path)
+        if args.report:
+            write_stage_report(stats['stages'], os.path.join(args.output, f"{name}.stages.{args.report}"))
+        _emit("done", file=source, stats=stats)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    # Через import: функции для воркеров должны жить в модуле pdf_engine, а не в __main__
+    import pdf_engine
+    sys.exit(pdf_engine.main())